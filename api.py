@@ -0,0 +1,309 @@
+"""
+Async JSON API for the map and search front end.
+
+map.html asks '/search_shops' for suggestions on every keystroke. Under
+gunicorn each of those calls holds a whole sync worker thread for the length
+of a query. This module serves the read-only JSON endpoints from one asyncio
+process instead, so thousands of open autocomplete requests cost a coroutine
+each rather than a thread:
+
+    GET /search_shops?query=...&limit=...   same response as the Flask route
+    GET /api/shops/<id>                     shop details and its barbers
+    GET /api/barbers/<id>                   barber, shop and rating aggregate
+    GET /api/barbers/<id>/stats             rating aggregate only
+
+Queries run on a small pool of read-only aiosqlite connections. Identical
+queries that are already running are not started again: later callers wait
+for the first one and share its result (see coalesce()), so a burst of
+people typing the same prefix costs one trip to SQLite.
+
+Run it next to the site and send these paths to it from the front proxy:
+
+    uvicorn api:app --port 8001
+
+The Flask routes stay in place, so the site still works without this process.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+
+import aiosqlite
+
+# the Flask app owns the schema and the search helpers; importing it also applies migrations
+import app as crimcuts
+import ranking
+
+DB_CONNECTIONS = int(os.environ.get("CRIMCUTS_API_DB_CONNECTIONS", 4))
+
+ROUTES = []
+
+
+def route(pattern, cache_control=None):
+    """
+    Register an async handler for GET requests whose path matches 'pattern'.
+    With 'cache_control', responses also get that header and an ETag.
+    """
+    def decorator(handler):
+        ROUTES.append((re.compile(pattern + "$"), handler, cache_control))
+        return handler
+    return decorator
+
+
+class NotFound(Exception):
+    """Raised by handlers to answer 404 with {"error": message}."""
+
+
+# Connection pool
+_pool = None
+
+
+async def open_pool(size=DB_CONNECTIONS):
+    global _pool
+    pool = asyncio.Queue()
+    path = os.path.abspath(crimcuts.app.config["DATABASE"])
+    for _ in range(size):
+        # read only: writes keep going through the Flask app
+        conn = await aiosqlite.connect(f"file:{path}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        for pragma in crimcuts.SQLITE_PRAGMAS:
+            await conn.execute(pragma)
+        await pool.put(conn)
+    _pool = pool
+
+
+async def close_pool():
+    global _pool
+    pool, _pool = _pool, None
+    while pool is not None and not pool.empty():
+        await (await pool.get()).close()
+
+
+@asynccontextmanager
+async def connection():
+    """Borrow a connection from the pool; waits while all of them are busy."""
+    if _pool is None:
+        await open_pool()
+    conn = await _pool.get()
+    try:
+        yield conn
+    finally:
+        _pool.put_nowait(conn)
+
+
+async def fetch_all(sql, params=()):
+    async with connection() as db:
+        async with db.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+
+async def fetch_one(sql, params=()):
+    async with connection() as db:
+        async with db.execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+
+# Request coalescing
+_in_flight = {}
+coalesce_stats = {"started": 0, "joined": 0}
+
+
+async def coalesce(key, make):
+    """
+    Run make() once per 'key' at a time and give every caller its result.
+
+    The shared task is shielded, so a client that hangs up does not cancel
+    the query for the others waiting on it.
+    """
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(make())
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+        coalesce_stats["started"] += 1
+    else:
+        coalesce_stats["joined"] += 1
+    return await asyncio.shield(task)
+
+
+# Queries
+async def find_shops(words, limit):
+    """Async twin of app.find_shops(), with the same SQL and typo fallback."""
+    rows = await fetch_all(crimcuts.SEARCH_SHOPS_SQL, (crimcuts.fts_prefix_query([[word] for word in words]), limit))
+    if rows:
+        return crimcuts.search_results_json(rows)
+
+    word_options = []
+    for word in words:
+        terms = await coalesce(("terms", word[0]), lambda: fetch_all(crimcuts.SEARCH_TERMS_SQL, crimcuts.search_terms_range(word)))
+        options = crimcuts.close_matches(word, [row["term"] for row in terms])
+        if not options:
+            return []
+        word_options.append(options)
+    rows = await fetch_all(crimcuts.SEARCH_SHOPS_SQL, (crimcuts.fts_prefix_query(word_options), limit))
+    return crimcuts.search_results_json(rows)
+
+
+def stats_json(row):
+    """Rating aggregate of one barber from a barber_rating_stats row (or None)."""
+    if row is None or not row["rating_count"]:
+        return {"avg_rating": None, "count_ratings": 0, "histogram": [0] * 5, "score": None, "trending": 0.0}
+    return {
+        "avg_rating": row["rating_sum"] / row["rating_count"],
+        "count_ratings": row["rating_count"],
+        "histogram": [row[f"stars_{stars}"] for stars in range(1, 6)],
+        "score": row["bayes_score"],
+        "trending": ranking.trend_value(row["trend_log"]),
+    }
+
+
+async def load_barber_stats(barber_id):
+    row = await fetch_one("SELECT * FROM barber_rating_stats WHERE barber_id = ?", (barber_id,))
+    return stats_json(row)
+
+
+async def load_barber(barber_id):
+    row = await fetch_one("""
+        SELECT
+            barbers.id, barbers.name, barbers.shop_id,
+            shops.name AS shop_name, shops.location AS shop_location
+        FROM barbers
+        JOIN shops ON shops.id = barbers.shop_id
+        WHERE barbers.id = ?
+    """, (barber_id,))
+    if row is None:
+        return None
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "shop": {"id": row["shop_id"], "name": row["shop_name"], "location": row["shop_location"]},
+        "stats": await load_barber_stats(barber_id),
+    }
+
+
+async def load_shop(shop_id):
+    shop = await fetch_one("""
+        SELECT id, name, location, website, description, latitude, longitude
+        FROM shops WHERE id = ?
+    """, (shop_id,))
+    if shop is None:
+        return None
+    barbers = await fetch_all("""
+        SELECT barbers.id, barbers.name, stats.rating_sum, stats.rating_count
+        FROM barbers
+        LEFT JOIN barber_rating_stats AS stats ON stats.barber_id = barbers.id
+        WHERE barbers.shop_id = ?
+        ORDER BY barbers.name
+    """, (shop_id,))
+    return {
+        **dict(shop),
+        "barbers": [
+            {
+                "id": row["id"],
+                "name": row["name"],
+                "avg_rating": row["rating_sum"] / row["rating_count"] if row["rating_count"] else None,
+                "count_ratings": row["rating_count"] or 0,
+            }
+            for row in barbers
+        ],
+    }
+
+
+# Endpoints
+def first_int(query, name):
+    try:
+        return int(query[name][0])
+    except (KeyError, ValueError):
+        return None
+
+
+@route(r"/search_shops", cache_control=crimcuts.SEARCH_CACHE_CONTROL)
+async def search_shops(query):
+    text = query.get("query", [""])[0].strip()
+    words = crimcuts.search_words(text)
+    if not words:
+        return []
+    limit = crimcuts.search_limit(first_int(query, "limit"))
+    # "Barb", "barb " and "BARB" are the same search
+    return await coalesce(("search", tuple(words), limit), lambda: find_shops(words, limit))
+
+
+@route(r"/api/shops/(\d+)")
+async def shop_detail(query, shop_id):
+    shop = await coalesce(("shop", int(shop_id)), lambda: load_shop(int(shop_id)))
+    if shop is None:
+        raise NotFound("Shop not found")
+    return shop
+
+
+@route(r"/api/barbers/(\d+)")
+async def barber_detail(query, barber_id):
+    barber = await coalesce(("barber", int(barber_id)), lambda: load_barber(int(barber_id)))
+    if barber is None:
+        raise NotFound("Barber not found")
+    return barber
+
+
+@route(r"/api/barbers/(\d+)/stats")
+async def barber_stats(query, barber_id):
+    return await coalesce(("stats", int(barber_id)), lambda: load_barber_stats(int(barber_id)))
+
+
+# ASGI application
+def request_header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def send_json(send, status, data, scope=None, cache_control=None):
+    body = json.dumps(data).encode()
+    headers = [(b"content-type", b"application/json")]
+    if cache_control is not None:
+        # same ETag and revalidation rules as the Flask route
+        etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        headers += [(b"etag", etag.encode()), (b"cache-control", cache_control.encode())]
+        if_none_match = request_header(scope, b"if-none-match") or ""
+        if etag in (tag.strip() for tag in if_none_match.split(",")):
+            status, body = 304, b""
+    headers.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await open_pool()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_pool()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    if scope["method"] not in ("GET", "HEAD"):
+        return await send_json(send, 405, {"error": "Method not allowed"})
+    for pattern, handler, cache_control in ROUTES:
+        match = pattern.match(scope["path"])
+        if match is None:
+            continue
+        query = parse_qs(scope["query_string"].decode("latin-1"))
+        try:
+            data = await handler(query, *match.groups())
+        except NotFound as e:
+            return await send_json(send, 404, {"error": str(e)})
+        return await send_json(send, 200, data, scope, cache_control)
+    await send_json(send, 404, {"error": "Not found"})
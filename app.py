@@ -1,31 +1,209 @@
-from flask import Flask, render_template, request, redirect, url_for, session, g, flash, jsonify
+from flask import Flask, Request, current_app, render_template, request, redirect, url_for, session, g, flash, jsonify, make_response, send_from_directory
+import os
+import re
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
+import sys
+import threading
 import difflib
+import functools
+import cProfile
+import hashlib
+import io
+import json
+import pstats
+import math
+import time
+import atexit
+import click
+from collections import OrderedDict, defaultdict, namedtuple
+
+import bulk
+import images
+import jobs
+import metrics
+import migrate
+import passwords
+import photo_store
+import ranking
+import sessions
+import snapshots
+import static_assets
+import write_behind
+from werkzeug.exceptions import RequestEntityTooLarge
 
 app = Flask(__name__)
 app.config["DEBUG"] = True
+app.config["DATABASE"] = os.environ.get("CRIMCUTS_DATABASE", "crimcuts.db")
+# largest photo we accept; the whole request may be a little larger for the other form fields
+app.config["MAX_PHOTO_BYTES"] = int(os.environ.get("CRIMCUTS_MAX_PHOTO_MB", 10)) * 1024 * 1024
+app.config["MAX_CONTENT_LENGTH"] = app.config["MAX_PHOTO_BYTES"] + 64 * 1024
 app.secret_key = "supersecretkey"
+# pbkdf2 iterations for new (and upgraded) password hashes, and the size of the hashing pool
+app.config["PASSWORD_HASH_ITERATIONS"] = int(os.environ.get("CRIMCUTS_PASSWORD_ITERATIONS", passwords.DEFAULT_ITERATIONS))
+app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("CRIMCUTS_PASSWORD_WORKERS", os.cpu_count() or 1))
+passwords.configure(
+    iterations=app.config["PASSWORD_HASH_ITERATIONS"],
+    workers=app.config["PASSWORD_HASH_WORKERS"],
+    max_pending=4 * max(app.config["PASSWORD_HASH_WORKERS"], 1),
+)
+
+# Static files: fingerprinted URLs, long-lived caching and precompressed
+# bodies, see static_assets.py. Hashed once at startup.
+STATIC_MANIFEST = static_assets.build_manifest(app.static_folder)
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    # url_for('static', filename=...) -> /static/...?v=<content hash>
+    if endpoint == "static" and "v" not in values:
+        asset = STATIC_MANIFEST.get(values.get("filename"))
+        if asset is not None:
+            values["v"] = asset.fingerprint
+
+def serve_static(filename):
+    """Replacement for Flask's static view with fingerprint-aware caching."""
+    asset = STATIC_MANIFEST.get(filename)
+    if asset is None:
+        response = send_from_directory(app.static_folder, filename)
+        # content-addressed photos never change under the same name
+        if photo_store.is_stored_photo("static/" + filename):
+            response.headers["Cache-Control"] = static_assets.IMMUTABLE
+        return response
+
+    encoding = static_assets.pick_encoding(asset, request.accept_encodings)
+    if encoding is not None:
+        response = app.response_class(asset.encoded[encoding], mimetype=asset.mimetype)
+        response.headers["Content-Encoding"] = encoding
+        response.set_etag(f"{asset.fingerprint}-{encoding}")
+        response = response.make_conditional(request)
+    else:
+        response = send_from_directory(app.static_folder, filename, etag=asset.fingerprint)
+    if asset.encoded:
+        response.vary.add("Accept-Encoding")
+
+    # only a URL naming the current version may be cached forever
+    if request.args.get("v") == asset.fingerprint:
+        response.headers["Cache-Control"] = static_assets.IMMUTABLE
+    else:
+        response.headers["Cache-Control"] = static_assets.REVALIDATE
+    return response
+
+app.view_functions["static"] = serve_static
+
+# Rendered-page cache for visitors who are not logged in.
+# A page is stored under its URL plus the current version of the data it shows;
+# writes bump the version (bump_data_version) so the next visitor gets a fresh render.
+# Each gunicorn worker has its own cache, so entries also expire after PAGE_CACHE_TTL
+# seconds to bound how stale a page can be after a write handled by another worker.
+PAGE_CACHE_SIZE = 1024
+PAGE_CACHE_TTL = 30
+
+# (path, versions) -> (expires_at, etag, body, mimetype), least recently used first
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+# data name ("shops", "barber:<id>") -> version
+_data_versions = defaultdict(int)
+# data name -> time.time() of the last bump, to spot pages rendered from an older snapshot
+_data_changed_at = {}
+
+def bump_data_version(*names):
+    """Mark data as changed so cached pages showing it are re-rendered."""
+    with _page_cache_lock:
+        now = time.time()
+        for name in names:
+            _data_versions[name] += 1
+            _data_changed_at[name] = now
+
+def cached_page(*depends_on):
+    """
+    Cache a view's rendered HTML for anonymous visitors, with ETag support.
+
+    'depends_on' names the data the page shows; names may use the view's URL
+    arguments, e.g. cached_page("barber:{barber_id}").
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            # logged-in pages show the username and forms, render them every time
+            if session.get("username"):
+                return view(**kwargs)
+
+            with _page_cache_lock:
+                versions = tuple(_data_versions[name.format(**kwargs)] for name in depends_on)
+                key = (request.full_path, versions)
+                entry = _page_cache.get(key)
+                if entry is not None and entry[0] < time.monotonic():
+                    del _page_cache[key]
+                    entry = None
+                if entry is not None:
+                    _page_cache.move_to_end(key)
+
+            if entry is None:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+                # read from a snapshot taken before the data last changed: show it, but do not keep it
+                taken_at = g.get("snapshot_taken_at")
+                if taken_at is not None and any(
+                    _data_changed_at.get(name.format(**kwargs), 0) > taken_at for name in depends_on
+                ):
+                    return response
+                body = response.get_data()
+                etag = hashlib.sha1(body).hexdigest()[:16]
+                entry = (time.monotonic() + PAGE_CACHE_TTL, etag, body, response.mimetype)
+                with _page_cache_lock:
+                    _page_cache[key] = entry
+                    if len(_page_cache) > PAGE_CACHE_SIZE:
+                        _page_cache.popitem(last=False)
+
+            _, etag, body, mimetype = entry
+            response = app.response_class(body, mimetype=mimetype)
+            response.set_etag(etag)
+            # browsers must check back, the page changes as soon as someone rates
+            response.headers["Cache-Control"] = "no-cache"
+            response.vary.add("Cookie")
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
 
 @app.route("/")
+@cached_page()
 def index():
     # if user is logged in, get username from session
     user=session.get("username")
     return render_template("index.html", user=session.get("username"))
 
+# Haircut photos: uploads are stored once per distinct picture as resized WebP
+# variants, see photo_store.py and images.py
+
+class CrimcutsRequest(Request):
+    """Request that streams uploaded files through photo_store.StreamedUpload."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return photo_store.StreamedUpload(current_app.config["MAX_PHOTO_BYTES"])
+
+app.request_class = CrimcutsRequest
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    max_mb = app.config["MAX_PHOTO_BYTES"] // (1024 * 1024)
+    return f"Upload too large: photos can be at most {max_mb} MB.", 413
+@app.template_global()
+def photo_urls(photo):
+    """
+    URLs of every size of a stored haircut photo, for <img src/srcset>.
+    None while the photo waits for its process_photo job.
+    """
+    if not photo_store.is_ready(photo):
+        return None
+    return {
+        variant: url_for("static", filename=path.replace("static/", "", 1))
+        for variant, path in images.photo_variants(photo).items()
+    }
+
 @app.route("/haircut_upload", methods=["GET", "POST"])
 def haircut_upload():
     db = get_db_connection()
     if request.method == "POST":
-        haircut_photo = request.files.get("photo")
-        img = None
-
-        # Save uploaded photo if present
-        if haircut_photo and haircut_photo.filename:
-            img_path = "static/barber_images/" + haircut_photo.filename
-            haircut_photo.save(img_path)
-            img = img_path
-
         barber_of_choice = request.form.get("barber", "").strip()
 
         # Validate barber exists
@@ -37,21 +215,31 @@ def haircut_upload():
         # If barber not found, return error
         if barber_row is None:
             error = "Please enter a valid barber: format is First_name Last_name"
-            db.close()
             return render_template("haircut_upload.html", error=error)
 
         barber_id = barber_row["id"]
 
+        # Resize and save uploaded photo if present
+        haircut_photo = request.files.get("photo")
+        img = None
+        if haircut_photo and haircut_photo.filename:
+            try:
+                img = store_uploaded_photo(db, haircut_photo.stream, barber_id)
+            except images.InvalidImage:
+                error = "That file is not an image we can read."
+                return render_template("haircut_upload.html", error=error)
+
         # Insert uploaded haircut photo with associated barber_id
         db.execute(
             "INSERT INTO haircut_photos (barber_id, photo) VALUES (?, ?)",
             (barber_id, img)
         )
         db.commit()
-        db.close()
+        # the barber's gallery shows it
+        bump_data_version(f"barber:{barber_id}")
+        job_runner.wake()
         return redirect(url_for("barbers"))
 
-    db.close()
     return render_template("haircut_upload.html")
 
 @app.route("/register", methods=["GET", "POST"])
@@ -92,23 +280,26 @@ def register():
             return render_template("register.html", error=error)
         
         try:
+            # hash password before storing (in the hashing pool, see passwords.py)
+            pw_hash = passwords.hash_password(password)
             # insert user into the database
-            conn = sqlite3.connect("crimcuts.db")
-            # hash password before storing
-            pw_hash = generate_password_hash(password, method="pbkdf2:sha256", salt_length=16)
+            conn = get_db_connection()
             conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, pw_hash),)
             # permanently save all changes made during the connection
             conn.commit()
-            # close the connection
-            conn.close()
+
+        except passwords.PasswordHasherBusy:
+            error = "The server is busy right now. Please try again in a moment."
+            return render_template("register.html", error=error)
 
         except sqlite3.IntegrityError:
+            conn.rollback()
             # if username already exists, return error
             error = "Username already exists. Please choose a different one."
             return render_template("register.html", error=error)
         
         # remember user
-        session["username"] = username
+        start_user_session(None, username)
         
         # on successful registration, redirect to home page
         return redirect(url_for("index"))
@@ -128,20 +319,35 @@ def login():
             return render_template("login.html", error=error)
 
         # fetch user from database
-        conn = sqlite3.connect("crimcuts.db")
-        conn.row_factory = sqlite3.Row
+        conn = get_db_connection()
         row = conn.execute("SELECT id, password FROM users WHERE username = ?", (username,))
         # returns a single row from the result
         row = row.fetchone()
-        conn.close()
 
         # check if user exists and password is correct
-        if row is None or not check_password_hash(row["password"], password):
+        if row is None:
             error = "Invalid username or password."
             return render_template("login.html", error=error)
+        try:
+            ok, rehash = passwords.verify_password(row["password"], password)
+        except passwords.PasswordHasherBusy:
+            error = "The server is busy right now. Please try again in a moment."
+            return render_template("login.html", error=error)
+        if not ok:
+            error = "Invalid username or password."
+            return render_template("login.html", error=error)
+        if rehash:
+            # stored hash uses old settings: replace it now that we know the password,
+            # or at a later login if the hasher is busy (the password was still correct)
+            try:
+                conn.execute("UPDATE users SET password = ? WHERE id = ?",
+                             (passwords.hash_password(password), row["id"]))
+                conn.commit()
+                passwords.record_rehash()
+            except passwords.PasswordHasherBusy:
+                pass
         # remember user
-        session["user_id"] = row["id"]
-        session["username"] = username
+        start_user_session(row["id"], username)
         # on successful login, redirect to home page
         return redirect(url_for("index"))
     
@@ -154,62 +360,685 @@ def logout():
     session.clear()
     return redirect(url_for("index"))
 
+# Password hashing metrics: latency, queue depth and settings of the hashing pool
+@app.route("/stats/passwords")
+def password_stats():
+    return jsonify(passwords.stats())
+
+# Request timing and SQL profiling, see metrics.py.
+# With CRIMCUTS_PROFILE=1, adding ?profile=1 to any URL returns a plain-text
+# dump of that request (its SQL statements and a cProfile report) instead of the page.
+app.config["PROFILE_REQUESTS"] = os.environ.get("CRIMCUTS_PROFILE") == "1"
+PROFILE_TOP_FUNCTIONS = 40
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+    if app.config["PROFILE_REQUESTS"] and request.args.get("profile"):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def profile_response(response):
+    # the status is recorded at teardown, see record_request_metrics()
+    g.response_status = response.status_code
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    return app.response_class(metrics.profile_report(metrics.current_profile(), out.getvalue()), mimetype="text/plain")
+
+# teardown also runs when the view raised, which after_request handlers may not
+@app.teardown_request
+def record_request_metrics(exc):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+    status = 500 if exc is not None else g.pop("response_status", 500)
+    # the URL rule ("/barbers/<int:barber_id>") keeps the number of labels bounded
+    route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    metrics.finish_request(route, request.method, status)
+
+@app.route("/metrics")
+def metrics_page():
+    password_metrics = {
+        f"crimcuts_passwords_{name}": (
+            "counter" if name.endswith(("_count", "_total")) else "gauge",
+            f"Password hashing: {name.replace('_', ' ')}.",
+            value,
+        )
+        for name, value in passwords.stats().items()
+    }
+    rating_write_metrics = {
+        f"crimcuts_rating_writes_{name}": (
+            "counter" if name not in ("pending", "batch_size_max") else "gauge",
+            f"Write-behind rating queue: {name.replace('_', ' ')}.",
+            value,
+        )
+        for name, value in rating_writes.stats().items()
+    }
+    job_metrics = {
+        f"crimcuts_jobs_{name}_total": ("counter", f"Background jobs {name} in this process.", value)
+        for name, value in job_runner.stats().items()
+    }
+    job_counts = jobs.counts(get_db_connection())
+    for status in ("queued", "running", "failed"):
+        job_metrics[f"crimcuts_jobs_{status}"] = ("gauge", f"Background jobs {status} (all processes).", job_counts.get(status, 0))
+    snapshot_metrics = {}
+    if snapshot_refresher is not None:
+        with _page_cache_lock:
+            reads = dict(_snapshot_reads)
+        snapshot_metrics = {
+            "crimcuts_snapshot_age_seconds": ("gauge", "Age of the read snapshot.", snapshot_refresher.age()),
+            "crimcuts_snapshot_reads_total": ("counter", "Read-only requests served from the snapshot.", reads["snapshot"]),
+            "crimcuts_snapshot_fallbacks_total": ("counter", "Read-only requests served from the database instead.", reads["primary"]),
+            **{
+                f"crimcuts_snapshot_{name}" + ("" if name.endswith("_total") else "_total"): (
+                    "counter", f"Snapshot refreshes in this process: {name.replace('_', ' ')}.", value,
+                )
+                for name, value in snapshot_refresher.stats().items()
+            },
+        }
+    return app.response_class(
+        metrics.render({**password_metrics, **rating_write_metrics, **job_metrics, **snapshot_metrics}),
+        mimetype="text/plain; version=0.0.4",
+    )
+
 # connecting to the database
+# Every connection gets these settings. WAL itself is stored in the database
+# file and is switched on once by init_db().
+SQLITE_PRAGMAS = (
+    # wait up to 5s for a writer instead of failing with "database is locked"
+    "PRAGMA busy_timeout = 5000",
+    # with WAL this only syncs at checkpoints and is still crash-safe
+    "PRAGMA synchronous = NORMAL",
+    # 16 MB page cache per connection (negative means KiB)
+    "PRAGMA cache_size = -16000",
+    # read the database file through a 256 MB memory map
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# one connection per worker thread, kept open between requests
+_db_pool = threading.local()
+
+def open_db_connection(database=None):
+    """Open a new, tuned connection to the database file (or to 'database', a path or file: URI)."""
+    # ProfiledConnection times every statement for /metrics
+    conn = sqlite3.connect(database or app.config["DATABASE"], uri=True, factory=metrics.ProfiledConnection)
+    # make rows behave like dictionaries: row["username"] instead of row[0]
+    conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    # leaderboard math used by migrations and rating updates
+    ranking.register_functions(conn)
+    return conn
+
 def get_db_connection():
     """
     Return a database connection for the current request.
 
-    - If this is the first time we ask for a connection in this request,
-      we open one and store it in 'g.db'.
-    - If we've already opened one, we just reuse it.
+    - Each worker thread keeps one connection open and reuses it for every
+      request it serves, so we do not reconnect (and re-run the pragmas) per request.
+    - The connection is remembered in 'g.db' for the rest of the request.
+    - Routes must not close it; teardown hands it back to the thread.
     """
     if "db" not in g:
-        # connect to the database file
-        g.db = sqlite3.connect("crimcuts.db")
-        # make rows behave like dictionaries: row["username"] instead of row[0]
-        g.db.row_factory = sqlite3.Row
+        conn = getattr(_db_pool, "conn", None)
+        if conn is None:
+            conn = _db_pool.conn = open_db_connection()
+        g.db = conn
     return g.db
 
-# when the request is over, if we opened a database connection, close it
+# when the request is over, give the connection back to the thread's pool
 @app.teardown_appcontext
-def close_db_connection(error):
+def release_db_connection(error):
     # Remove "db" from g if it exists, else return None
     db = g.pop("db", None)
-    if db is not None:
-        db.close()
+    # a request that failed half way must not leave its writes (and the write lock) behind
+    if db is not None and db.in_transaction:
+        db.rollback()
+
+# Schema: every table, index and trigger is created by the numbered files in
+# migrations/, applied on startup by init_db() (see migrate.py)
+def init_db():
+    """Bring the database schema up to date."""
+    conn = open_db_connection()
+    # readers no longer wait for writers (and vice versa); this setting is persistent
+    conn.execute("PRAGMA journal_mode = WAL")
+    for name in migrate.migrate(conn):
+        app.logger.info("Applied migration %s", name)
+    version = migrate.current_version(conn)
+    conn.close()
+    return version
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Apply pending schema migrations (startup already does this)."""
+    version = init_db()
+    print(f"Database is at schema version {version}.")
+
+# Snapshot mode (see snapshots.py). With CRIMCUTS_READ_SNAPSHOT=<file>, read-only routes
+# read from a copy of the database that is at most CRIMCUTS_SNAPSHOT_MAX_AGE seconds old,
+# and only writes (and reads that must see them) use the database itself. Every process
+# refreshes the copy in a background thread unless CRIMCUTS_SNAPSHOT_REFRESH=0, in which case
+# run 'flask --app app snapshot --every <seconds>' instead.
+app.config["READ_SNAPSHOT"] = os.environ.get("CRIMCUTS_READ_SNAPSHOT")
+app.config["SNAPSHOT_MAX_AGE"] = float(os.environ.get("CRIMCUTS_SNAPSHOT_MAX_AGE", 5))
+app.config["SNAPSHOT_REFRESH"] = os.environ.get("CRIMCUTS_SNAPSHOT_REFRESH", "1") == "1"
+
+snapshot_reader = None
+snapshot_refresher = None
+if app.config["READ_SNAPSHOT"]:
+    snapshot_reader = snapshots.SnapshotReader(app.config["READ_SNAPSHOT"], app.config["SNAPSHOT_MAX_AGE"], open_db_connection)
+    snapshot_refresher = snapshots.SnapshotRefresher(app.config["DATABASE"], app.config["READ_SNAPSHOT"], app.config["SNAPSHOT_MAX_AGE"])
+
+# reads served from the snapshot and from the database, for /metrics
+_snapshot_reads = {"snapshot": 0, "primary": 0}
+
+@app.before_request
+def start_snapshot_refresher():
+    if snapshot_refresher is not None and app.config["SNAPSHOT_REFRESH"]:
+        snapshot_refresher.start()
+
+def get_read_connection():
+    """
+    Connection for read-only routes: the snapshot in snapshot mode, if it is
+    fresh enough and newer than the user's last write; the database otherwise.
+    Routes must not write through it.
+    """
+    if snapshot_reader is None:
+        return get_db_connection()
+    if "read_db" not in g:
+        snapshot = None
+        # a queued rating must be waited for on the database (wait_for_own_rating)
+        if not session.get("rating_writes"):
+            snapshot = snapshot_reader.connection()
+        if snapshot is not None and session.get("wrote_at", 0) >= snapshot[1]:
+            snapshot = None
+        with _page_cache_lock:
+            _snapshot_reads["primary" if snapshot is None else "snapshot"] += 1
+        if snapshot is None:
+            g.read_db = get_db_connection()
+        else:
+            g.read_db, g.snapshot_taken_at = snapshot
+    return g.read_db
+
+# users read the database until a snapshot includes what they just wrote
+@app.after_request
+def remember_write_time(response):
+    if (snapshot_reader is not None and request.method == "POST" and response.status_code < 400
+            and "user_id" in session):
+        session["wrote_at"] = time.time()
+    return response
+
+@app.cli.command("snapshot")
+@click.option("--every", type=float, help="Keep refreshing, every this many seconds.")
+def snapshot_command(every):
+    """Refresh the read snapshot (CRIMCUTS_READ_SNAPSHOT) from the database."""
+    if snapshot_refresher is None:
+        raise click.UsageError("Set CRIMCUTS_READ_SNAPSHOT to the snapshot file first.")
+    while True:
+        result = snapshot_refresher.refresh()
+        print(f"Snapshot {app.config['READ_SNAPSHOT']}: {result}")
+        if every is None:
+            break
+        time.sleep(every)
+
+# Sessions: the cookie only carries a random id, the data is kept server side
+# (see sessions.py). CRIMCUTS_SESSION_BACKEND picks the store:
+#   sqlite  - the sessions table with an in-memory LRU in front (default)
+#   memory  - a dict in this process, for development with a single process
+#   cookie  - Flask's signed cookie sessions
+app.config["SESSION_BACKEND"] = os.environ.get("CRIMCUTS_SESSION_BACKEND", "sqlite")
+if app.config["SESSION_BACKEND"] == "sqlite":
+    app.session_interface = sessions.ServerSideSessionInterface(sessions.SQLiteSessionStore(open_db_connection))
+elif app.config["SESSION_BACKEND"] == "memory":
+    app.session_interface = sessions.ServerSideSessionInterface(sessions.MemorySessionStore())
+
+def start_user_session(user_id, username):
+    """Log a user in, under a fresh session id (no session fixation)."""
+    session.clear()
+    if isinstance(session, sessions.ServerSession):
+        session.rotate()
+    if user_id is not None:
+        session["user_id"] = user_id
+    session["username"] = username
+
+# User profiles by id. Usernames never change and users are never deleted,
+# so entries only leave the cache when it is full.
+USER_CACHE_SIZE = 10000
+
+# user id -> {"id": ..., "username": ...}, least recently used first
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+def get_users(db, user_ids):
+    """Return {user_id: profile} for the ids that exist, reading only uncached ones."""
+    found = {}
+    missing = []
+    with _user_cache_lock:
+        for user_id in set(user_ids):
+            profile = _user_cache.get(user_id)
+            if profile is None:
+                missing.append(user_id)
+            else:
+                _user_cache.move_to_end(user_id)
+                found[user_id] = profile
+
+    # stay below SQLite's limit on bound parameters
+    for start in range(0, len(missing), 500):
+        chunk = missing[start:start + 500]
+        rows = db.execute(
+            f"SELECT id, username FROM users WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+        ).fetchall()
+        with _user_cache_lock:
+            for row in rows:
+                profile = {"id": row["id"], "username": row["username"]}
+                _user_cache[row["id"]] = found[row["id"]] = profile
+            while len(_user_cache) > USER_CACHE_SIZE:
+                _user_cache.popitem(last=False)
+    return found
+
+def get_user(db, user_id):
+    return get_users(db, [user_id]).get(user_id)
+
+# who is logged in, checked once per request against the user cache
+@app.before_request
+def load_logged_in_user():
+    user_id = session.get("user_id")
+    g.user = None
+    if user_id is not None:
+        g.user = get_user(get_db_connection(), user_id)
+        if g.user is None:
+            # the account is gone, the session is worthless
+            session.clear()
+
+def rebuild_rating_stats(db, barber_ids=None):
+    """
+    Recompute barber_rating_stats from the ratings table: every row, or
+    only the rows of 'barber_ids'.
+    """
+    if barber_ids is not None:
+        barber_ids = list(barber_ids)
+        # stay below SQLite's limit on bound parameters
+        for start in range(0, len(barber_ids), 500):
+            chunk = barber_ids[start:start + 500]
+            _rebuild_rating_stats(db, f"IN ({', '.join('?' * len(chunk))})", chunk)
+        return
+    db.execute("DELETE FROM barber_rating_stats")
+    _rebuild_rating_stats(db, None, ())
+
+def _rebuild_rating_stats(db, barber_filter, params):
+    where = ""
+    if barber_filter is not None:
+        db.execute(f"DELETE FROM barber_rating_stats WHERE barber_id {barber_filter}", params)
+        where = f"WHERE ratings.barber_id {barber_filter}"
+    db.execute(f"""
+        INSERT INTO barber_rating_stats
+            (barber_id, shop_id, rating_sum, rating_count,
+             stars_1, stars_2, stars_3, stars_4, stars_5, last_rated_at,
+             bayes_score, trend_log)
+        SELECT
+            ratings.barber_id,
+            barbers.shop_id,
+            SUM(rating),
+            COUNT(*),
+            SUM(rating = 1), SUM(rating = 2), SUM(rating = 3), SUM(rating = 4), SUM(rating = 5),
+            MAX(created_at),
+            ranking_bayes(SUM(rating), COUNT(*)),
+            ranking_trend_sum(rating, created_at)
+        FROM ratings
+        LEFT JOIN barbers ON barbers.id = ratings.barber_id
+        {where}
+        GROUP BY ratings.barber_id
+    """, params)
+
+def update_rating_stats(db, barber_id, old_rating, new_rating, rated_at):
+    """
+    Apply one rating change to barber_rating_stats.
+
+    - old_rating is None for a new rating
+    - new_rating is None for a deleted rating
+    - rated_at is the rating's created_at, which places it in the trending score
+      and in last_rated_at (the latest created_at, as in rebuild_rating_stats)
+    The caller commits, so the stats change lands in the same transaction
+    as the change to the ratings table.
+    """
+    stars = [0, 0, 0, 0, 0]
+    rating_sum = 0
+    rating_count = 0
+    removed_term = None
+    added_term = None
+    if old_rating is not None:
+        stars[old_rating - 1] -= 1
+        rating_sum -= old_rating
+        rating_count -= 1
+        removed_term = ranking.trend_term(old_rating, rated_at)
+    if new_rating is not None:
+        stars[new_rating - 1] += 1
+        rating_sum += new_rating
+        rating_count += 1
+        added_term = ranking.trend_term(new_rating, rated_at)
+
+    db.execute("""
+        INSERT INTO barber_rating_stats (barber_id, shop_id)
+        SELECT id, shop_id FROM barbers WHERE id = ?
+        ON CONFLICT(barber_id) DO NOTHING
+    """, (barber_id,))
+    # SET expressions all see the old row, so rating_sum + ? is the new sum everywhere
+    db.execute("""
+        UPDATE barber_rating_stats
+        SET rating_sum = rating_sum + ?,
+            rating_count = rating_count + ?,
+            stars_1 = stars_1 + ?,
+            stars_2 = stars_2 + ?,
+            stars_3 = stars_3 + ?,
+            stars_4 = stars_4 + ?,
+            stars_5 = stars_5 + ?,
+            -- MAX(created_at): a new rating may move it forward, an edit keeps
+            -- created_at so it never moves, and deleting the latest rating looks it up
+            -- again (the caller has already deleted the row)
+            last_rated_at = CASE
+                WHEN ? THEN max(COALESCE(last_rated_at, ?), ?)
+                WHEN ? AND last_rated_at <= ? THEN
+                    (SELECT MAX(created_at) FROM ratings WHERE ratings.barber_id = barber_rating_stats.barber_id)
+                ELSE last_rated_at
+            END,
+            bayes_score = ranking_bayes(rating_sum + ?, rating_count + ?),
+            -- NULL only without ratings; when the removed rating outweighed all the
+            -- older ones beyond float precision, sum the ones that are left
+            trend_log = CASE
+                WHEN rating_count + ? = 0 THEN NULL
+                ELSE COALESCE(
+                    ranking_trend_update(trend_log, ?, ?),
+                    (SELECT ranking_trend_sum(rating, created_at) FROM ratings
+                     WHERE ratings.barber_id = barber_rating_stats.barber_id)
+                )
+            END
+        WHERE barber_id = ?
+    """, (rating_sum, rating_count, *stars,
+          old_rating is None, rated_at, rated_at,
+          new_rating is None, rated_at,
+          rating_sum, rating_count,
+          rating_count, removed_term, added_term, barber_id))
+
+@app.cli.command("rebuild-ratings")
+def rebuild_ratings_command():
+    """Recompute the per-barber rating aggregates from scratch."""
+    conn = open_db_connection()
+    rebuild_rating_stats(conn)
+    conn.commit()
+    count = conn.execute("SELECT COUNT(*) FROM barber_rating_stats").fetchone()[0]
+    conn.close()
+    print(f"Rebuilt rating aggregates for {count} barbers.")
+
+@app.cli.command("photos-gc")
+def photos_gc_command():
+    """Recount photo references and delete stored photos nothing uses."""
+    conn = open_db_connection()
+    photo_store.rebuild_refs(conn)
+    conn.commit()
+    removed = photo_store.collect_garbage(conn)
+    orphans = photo_store.remove_orphan_files(conn)
+    conn.close()
+    print(f"Removed {removed} unreferenced photos and {orphans} orphan files.")
+
+def move_photo_rows(db, old, new):
+    """Point every row using photo 'old' at 'new' and count the references. The caller commits."""
+    # the ratings trigger re-adds the gallery entry as the newest photo; put it back in its place
+    gallery = db.execute(
+        "SELECT id, rating_id, created_at FROM gallery_photos WHERE photo = ? AND rating_id IS NOT NULL", (old,)
+    ).fetchall()
+    moved = db.execute("UPDATE ratings SET photo = ? WHERE photo = ?", (new, old)).rowcount
+    for row in gallery:
+        db.execute("UPDATE gallery_photos SET id = ?, created_at = ? WHERE rating_id = ?",
+                   (row["id"], row["created_at"], row["rating_id"]))
+    moved += db.execute("UPDATE haircut_photos SET photo = ? WHERE photo = ?", (new, old)).rowcount
+    db.execute("UPDATE gallery_photos SET photo = ? WHERE photo = ?", (new, old))
+    db.execute("""
+        INSERT INTO photo_blobs (photo, ref_count) VALUES (?, ?)
+        ON CONFLICT(photo) DO UPDATE SET ref_count = ref_count + excluded.ref_count
+    """, (new, moved))
+
+@app.cli.command("photos-migrate-legacy")
+def photos_migrate_legacy_command():
+    """Move photos saved before content addressing into the photo store and delete the copies."""
+    conn = open_db_connection()
+    legacy = [
+        row[0] for row in conn.execute("""
+            SELECT DISTINCT photo FROM (SELECT photo FROM ratings UNION ALL SELECT photo FROM haircut_photos)
+            WHERE photo IS NOT NULL
+        """)
+        if not photo_store.is_stored_photo(row[0])
+    ]
+    moved, skipped = 0, []
+    for old in legacy:
+        # resize before taking the write lock, as store_photo() does
+        try:
+            new = photo_store.store_file(old)
+        except (OSError, images.InvalidImage) as e:
+            skipped.append(f"{old}: {e}")
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # collect_garbage() may have removed an identical photo in between
+            if not os.path.exists(new):
+                photo_store.store_file(old)
+            move_photo_rows(conn, old, new)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        # no row uses it any more, and new uploads never get such a path
+        os.remove(old)
+        moved += 1
+    conn.close()
+    print(f"Moved {moved} legacy photos into {photo_store.STORE_DIR}, {len(skipped)} skipped.")
+    for line in skipped:
+        print(f"  {line}")
+
+# Background jobs (see jobs.py), kept in the jobs table. Each web process runs
+# CRIMCUTS_JOB_THREADS job threads (0: leave them to 'flask --app app jobs-worker').
+app.config["JOB_THREADS"] = int(os.environ.get("CRIMCUTS_JOB_THREADS", 1))
+job_runner = jobs.JobRunner(open_db_connection, app.config["JOB_THREADS"])
+
+# started by the first request, so CLI commands and forked workers do not inherit threads
+@app.before_request
+def start_job_runner():
+    job_runner.start()
+
+def store_uploaded_photo(db, stream, barber_id):
+    """
+    Save an uploaded photo and queue its resizing (process_photo job); the caller commits.
+    Raises images.InvalidImage if the upload is not an image.
+    """
+    photo = photo_store.store_photo(db, stream, defer=True)
+    if not photo_store.is_ready(photo):
+        jobs.enqueue(db, "process_photo", {"photo": photo, "barber_id": barber_id})
+    return photo
+
+@jobs.handler("process_photo")
+def process_photo_job(db, payload):
+    try:
+        processed = photo_store.process_photo(payload["photo"])
+    except images.InvalidImage as e:
+        # the header looked fine but the image does not decode, retrying will not help
+        raise jobs.JobFailed(str(e))
+    if processed:
+        # cached pages of this barber were rendered without the photo
+        bump_data_version(f"barber:{payload['barber_id']}")
+
+@jobs.handler("collect_photo_garbage")
+def collect_photo_garbage_job(db, payload):
+    photo_store.collect_garbage(db)
+
+@app.cli.command("jobs-worker")
+@click.option("--threads", default=2, show_default=True, help="Jobs run at once.")
+def jobs_worker_command(threads):
+    """Run background jobs until interrupted."""
+    runner = jobs.JobRunner(open_db_connection, threads)
+    for number in range(1, threads):
+        threading.Thread(target=runner.run, name=f"jobs-{number}", daemon=True).start()
+    print(f"Running jobs with {threads} threads, Ctrl+C to stop.")
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        runner.stop()
+
+@app.cli.command("jobs-status")
+def jobs_status_command():
+    """Show how many jobs are queued, running and failed, and the latest failures."""
+    conn = open_db_connection()
+    print(jobs.counts(conn) or "No jobs.")
+    for row in conn.execute("""
+        SELECT id, kind, attempts, last_error FROM jobs WHERE status = 'failed' ORDER BY id DESC LIMIT 10
+    """):
+        print(f"  #{row['id']} {row['kind']} ({row['attempts']} attempts): {row['last_error']}")
+    conn.close()
+
+@app.cli.command("jobs-retry")
+@click.option("--kind", help="Only jobs of this kind.")
+def jobs_retry_command(kind):
+    """Queue failed jobs again."""
+    conn = open_db_connection()
+    count = jobs.retry_failed(conn, kind)
+    conn.commit()
+    conn.close()
+    print(f"Queued {count} failed jobs again.")
+
+# In-process cache of the /barbers shop directory.
+# Built from a single JOIN and dropped whenever a shop or barber is added,
+# so warm requests to /barbers never touch SQLite. Only this process can drop it;
+# writes handled by another gunicorn worker or by 'flask import-data' show up once
+# it expires after SHOP_CACHE_TTL seconds. The map tiles use the same TTL.
+SHOP_CACHE_TTL = 30
+
+# (expires_at, directory)
+_shop_directory = None
+_shop_directory_lock = threading.Lock()
+
+def load_shop_directory(db):
+    """
+    Build the list of {"shop": ..., "barbers": [...]} entries for /barbers
+    with one query instead of one query per shop.
+    """
+    rows = db.execute("""
+        SELECT
+            shops.id          AS shop_id,
+            shops.name        AS shop_name,
+            shops.location    AS shop_location,
+            shops.website     AS shop_website,
+            shops.description AS shop_description,
+            barbers.id        AS barber_id,
+            barbers.name      AS barber_name
+        FROM shops
+        LEFT JOIN barbers ON barbers.shop_id = shops.id
+        ORDER BY shops.name ASC, shops.id ASC, barbers.name ASC
+    """).fetchall()
+
+    result = []
+    current = None
+    for row in rows:
+        # rows are ordered by shop, so a new shop id starts a new entry
+        if current is None or current["shop"]["id"] != row["shop_id"]:
+            current = {
+                "shop": {
+                    "id": row["shop_id"],
+                    "name": row["shop_name"],
+                    "location": row["shop_location"],
+                    "website": row["shop_website"],
+                    "description": row["shop_description"],
+                },
+                "barbers": []
+            }
+            result.append(current)
+        # LEFT JOIN gives a row with NULL barber columns for shops with no barbers
+        if row["barber_id"] is not None:
+            current["barbers"].append({"id": row["barber_id"], "name": row["barber_name"]})
+    return result
+
+def get_shop_directory():
+    """Return the cached shop directory, loading it when missing or expired."""
+    global _shop_directory
+    entry = _shop_directory
+    if entry is None or entry[0] < time.monotonic():
+        with _shop_directory_lock:
+            entry = _shop_directory
+            if entry is None or entry[0] < time.monotonic():
+                # from the database, not the snapshot: it may stay cached for SHOP_CACHE_TTL
+                entry = (time.monotonic() + SHOP_CACHE_TTL, load_shop_directory(get_db_connection()))
+                _shop_directory = entry
+    return entry[1]
+
+def invalidate_shop_directory():
+    """Forget the cached shop directory after shops or barbers change."""
+    global _shop_directory
+    with _shop_directory_lock:
+        _shop_directory = None
 
 # Barbers listing page
 @app.route("/barbers")
+@cached_page("shops")
 def barbers():
-    db = get_db_connection()
-    shops = db.execute("""SELECT id, name, location, website, description FROM shops ORDER BY name ASC""").fetchall()
-    result = []
-    # For each shop, get its barbers
-    for shop in shops:
-        shop_barbers = db.execute("""
-            SELECT id, name FROM barbers
-            WHERE shop_id = ?
-            ORDER BY name ASC
-        """, (shop["id"],)).fetchall()
-        
-        # Append shop and its barbers to result
-        result.append({
-            "shop": shop,
-            "barbers": shop_barbers
-        })
-
+    result = get_shop_directory()
     return render_template("barbers.html", shops = result, user=session.get("username"))
 
+# Ratings are paged newest first with a cursor on ratings.id
+# (keyset pagination), served by idx_ratings_barber_id.
+RATINGS_PAGE_SIZE = 20
+
+def fetch_ratings_page(db, barber_id, before=None, limit=RATINGS_PAGE_SIZE):
+    """
+    Return (ratings, next_cursor) for one page of a barber's ratings.
+
+    'before' is the id of the last rating already shown (None for the first page);
+    next_cursor is the value to pass as 'before' for the following page,
+    or None if there are no more ratings.
+    """
+    rows = db.execute("""
+        SELECT
+            ratings.id      AS rating_id,
+            ratings.rating  AS rating_value,
+            ratings.comment AS rating_comment,
+            ratings.photo   AS photo,
+            ratings.user_id AS user_id
+        FROM ratings
+        WHERE ratings.barber_id = ? AND ratings.id < ?
+        ORDER BY ratings.id DESC
+        LIMIT ?
+    """, (barber_id, before if before is not None else sys.maxsize, limit + 1)).fetchall()
+
+    # we asked for one extra row just to know whether another page exists;
+    # decided before dropping rows without a user, so those cannot end the paging early
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["rating_id"]
+
+    # usernames come from the user cache instead of a join on every row
+    users = get_users(db, [row["user_id"] for row in rows])
+    rows = [
+        {**row, "username": users[row["user_id"]]["username"]}
+        for row in rows
+        if row["user_id"] in users
+    ]
+    return rows, next_cursor
+
 # Barber detail page with ratings
 @app.route("/barbers/<int:barber_id>")
+@cached_page("barber:{barber_id}")
 def barber_detail(barber_id):
-    db = get_db_connection()
+    db = get_read_connection()
 
     # Barber and shop info
     barber = db.execute("""
         SELECT
             barbers.id        AS barber_id,
             barbers.name      AS barber_name,
+            shops.id          AS shop_id,
             shops.name        AS shop_name,
             shops.location    AS shop_location,
             shops.website     AS shop_website,
@@ -223,45 +1052,258 @@ def barber_detail(barber_id):
     if barber is None:
         return "Barber not found", 404
 
-    # Ratings for this barber
-    ratings = db.execute("""
-        SELECT
-            ratings.rating  AS rating_value,
-            ratings.comment AS rating_comment,
-            ratings.photo   AS photo,
-            users.username  AS username
-        FROM ratings
-        JOIN users ON ratings.user_id = users.id
-        WHERE ratings.barber_id = ?
-        ORDER BY ratings.id DESC
-    """, (barber_id,)).fetchall()
+    # the user's own rating, if it is still queued, shows up before we read
+    if "user_id" in session:
+        wait_for_own_rating(db, barber_id)
 
-    # Average rating
-    avg_row = db.execute("""
-        SELECT AVG(rating) AS avg_rating, COUNT(*) AS count_ratings
-        FROM ratings
+    # First page of ratings for this barber; ?before=<rating id> shows older ones
+    before = request.args.get("before", type=int)
+    ratings, next_cursor = fetch_ratings_page(db, barber_id, before)
+
+    # Average rating, from the aggregate kept up to date by rate_barber/delete_rating
+    stats = db.execute("""
+        SELECT rating_sum, rating_count
+        FROM barber_rating_stats
         WHERE barber_id = ?
     """, (barber_id,)).fetchone()
 
     # Handle case with no ratings
-    if avg_row is None:
+    if stats is None or stats["rating_count"] == 0:
         avg_rating = None
         count_ratings = 0
     else:
-        avg_rating = avg_row["avg_rating"]
-        count_ratings = avg_row["count_ratings"]
+        avg_rating = stats["rating_sum"] / stats["rating_count"]
+        count_ratings = stats["rating_count"]
 
     # Render the barber detail template
     return render_template(
         "barber_detail.html",
         barber=barber,
         ratings=ratings,
+        next_cursor=next_cursor,
         avg_rating=avg_rating,
         count_ratings=count_ratings,
         user=session.get("username")
     )
 
 
+# JSON page of ratings for the "Load more" button on the barber page
+@app.route("/barbers/<int:barber_id>/ratings")
+def barber_ratings(barber_id):
+    before = request.args.get("before", type=int)
+    limit = request.args.get("limit", RATINGS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, 100))
+
+    db = get_read_connection()
+    if "user_id" in session:
+        wait_for_own_rating(db, barber_id)
+    ratings, next_cursor = fetch_ratings_page(db, barber_id, before, limit)
+    return jsonify({
+        "ratings": [
+            {
+                "id": row["rating_id"],
+                "username": row["username"],
+                "rating": row["rating_value"],
+                "comment": row["rating_comment"],
+                "photo": photo_urls(row["photo"]) if row["photo"] else None,
+            }
+            for row in ratings
+        ],
+        "next_cursor": next_cursor,
+    })
+
+# Photo galleries of one barber or a whole shop: rating photos and photos uploaded
+# through /haircut_upload, newest first. They are read from gallery_photos, which
+# triggers keep in sync with ratings and haircut_photos, with a cursor on its id
+# (like the ratings list), so each page is one indexed query however many photos
+# a shop has. The page shows thumbnails and loads more as the visitor scrolls.
+GALLERY_PAGE_SIZE = 24
+GALLERY_MAX_PAGE_SIZE = 100
+# whose photos -> gallery_photos column (each has an index with id)
+GALLERY_OWNERS = {"barber": "barber_id", "shop": "shop_id"}
+
+def fetch_gallery_page(db, owner, owner_id, before=None, limit=GALLERY_PAGE_SIZE):
+    """
+    Return (photos, next_cursor) for one page of a barber's or shop's gallery.
+
+    'owner' is "barber" or "shop"; 'before' and next_cursor work as in
+    fetch_ratings_page(). Photos still waiting to be resized are left out.
+    """
+    rows = db.execute(f"""
+        SELECT
+            gallery_photos.id        AS id,
+            gallery_photos.photo     AS photo,
+            gallery_photos.barber_id AS barber_id,
+            barbers.name             AS barber_name
+        FROM gallery_photos
+        JOIN barbers ON barbers.id = gallery_photos.barber_id
+        WHERE gallery_photos.{GALLERY_OWNERS[owner]} = ? AND gallery_photos.id < ?
+        ORDER BY gallery_photos.id DESC
+        LIMIT ?
+    """, (owner_id, before if before is not None else sys.maxsize, limit + 1)).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["id"]
+
+    photos = []
+    for row in rows:
+        urls = photo_urls(row["photo"])
+        if urls is not None:
+            photos.append({
+                "id": row["id"],
+                "barber_id": row["barber_id"],
+                "barber_name": row["barber_name"],
+                "thumb": urls["thumb"],
+                "full": urls["full"],
+            })
+    return photos, next_cursor
+
+def gallery_page(owner, owner_id, title, photos_url):
+    photos, next_cursor = fetch_gallery_page(get_read_connection(), owner, owner_id, request.args.get("before", type=int))
+    return render_template(
+        "gallery.html",
+        title=title,
+        owner=owner,
+        photos=photos,
+        next_cursor=next_cursor,
+        photos_url=photos_url,
+        user=session.get("username"),
+    )
+
+def gallery_json(owner, owner_id):
+    limit = request.args.get("limit", GALLERY_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, GALLERY_MAX_PAGE_SIZE))
+    photos, next_cursor = fetch_gallery_page(
+        get_read_connection(), owner, owner_id, request.args.get("before", type=int), limit
+    )
+    return jsonify({"photos": photos, "next_cursor": next_cursor})
+
+# Gallery of one barber
+@app.route("/barbers/<int:barber_id>/gallery")
+@cached_page("barber:{barber_id}")
+def barber_gallery(barber_id):
+    barber = get_read_connection().execute("SELECT name FROM barbers WHERE id = ?", (barber_id,)).fetchone()
+    if barber is None:
+        return "Barber not found", 404
+    return gallery_page("barber", barber_id, barber["name"], url_for("barber_gallery_photos", barber_id=barber_id))
+
+@app.route("/barbers/<int:barber_id>/gallery/photos")
+def barber_gallery_photos(barber_id):
+    return gallery_json("barber", barber_id)
+
+# Gallery of every barber in a shop. Not page-cached: rating writes do not know
+# the shop, and the page is a single indexed query anyway.
+@app.route("/shops/<int:shop_id>/gallery")
+def shop_gallery(shop_id):
+    shop = get_read_connection().execute("SELECT name FROM shops WHERE id = ?", (shop_id,)).fetchone()
+    if shop is None:
+        return "Shop not found", 404
+    return gallery_page("shop", shop_id, shop["name"], url_for("shop_gallery_photos", shop_id=shop_id))
+
+@app.route("/shops/<int:shop_id>/gallery/photos")
+def shop_gallery_photos(shop_id):
+    return gallery_json("shop", shop_id)
+
+# Writing ratings.
+# A change is a RatingChange; rating None deletes the user's rating of that barber.
+# By default the request applies it itself. With CRIMCUTS_RATING_WRITE_BEHIND=1 the
+# request only validates it and queues it for one background writer per process,
+# which applies everything waiting in one transaction (see write_behind.py), so a
+# burst of ratings does not keep request threads waiting on SQLite's write lock.
+app.config["RATING_WRITE_BEHIND"] = os.environ.get("CRIMCUTS_RATING_WRITE_BEHIND") == "1"
+# how long a user's next page waits for their own queued rating
+RATING_WRITE_WAIT = 2.0
+
+RatingChange = namedtuple("RatingChange", "user_id barber_id rating comment photo")
+
+def apply_rating_change(db, change):
+    """
+    Write one rating change with its stats and photo references; the caller commits.
+
+    Returns the rating row it replaced or deleted, None if there was none.
+    """
+    previous = db.execute("""
+        SELECT rating, photo, created_at FROM ratings
+        WHERE user_id = ? AND barber_id = ?
+    """, (change.user_id, change.barber_id)).fetchone()
+
+    if change.rating is None:
+        if previous is None:
+            return None
+        db.execute("DELETE FROM ratings WHERE user_id = ? AND barber_id = ?", (change.user_id, change.barber_id))
+        update_rating_stats(db, change.barber_id, previous["rating"], None, previous["created_at"])
+    else:
+        # one row per user and barber (idx_unique_user_barber); an update keeps created_at
+        created_at = ranking.now_timestamp()
+        db.execute("""
+            INSERT INTO ratings (user_id, barber_id, rating, comment, photo, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, barber_id) DO UPDATE SET
+                rating = excluded.rating, comment = excluded.comment, photo = excluded.photo
+        """, (change.user_id, change.barber_id, change.rating, change.comment, change.photo, created_at))
+        if previous is None:
+            update_rating_stats(db, change.barber_id, None, change.rating, created_at)
+        else:
+            update_rating_stats(db, change.barber_id, previous["rating"], change.rating, previous["created_at"])
+
+    # the old photo is replaced or deleted with the rating; its files go in a job
+    if previous is not None and photo_store.release_photo(db, previous["photo"]):
+        jobs.enqueue(db, "collect_photo_garbage", unique=True)
+    return previous
+
+def ratings_written(db, changes, results):
+    """After the writer commits: refresh cached pages and start queued jobs."""
+    bump_data_version(*{f"barber:{change.barber_id}" for change in changes})
+    job_runner.wake()
+
+def rating_write_failed(db, change, error):
+    # the request already counted a reference to the new photo
+    if photo_store.release_photo(db, change.photo):
+        jobs.enqueue(db, "collect_photo_garbage", unique=True)
+        db.commit()
+        job_runner.wake()
+
+rating_writes = write_behind.WriteBehindQueue(
+    open_db_connection, apply_rating_change, after_commit=ratings_written, on_error=rating_write_failed,
+)
+# apply what is still queued when the worker shuts down
+atexit.register(rating_writes.flush, timeout=10)
+
+def queue_rating_change(change):
+    """Queue a change and remember it in the session until the user has seen it applied."""
+    rating_writes.submit(change)
+    expected = None if change.rating is None else [change.rating, change.comment, change.photo]
+    session["rating_writes"] = {**session.get("rating_writes", {}), str(change.barber_id): expected}
+
+def wait_for_own_rating(db, barber_id):
+    """
+    Read-your-writes: if the user has a queued change to this barber's rating,
+    wait (up to RATING_WRITE_WAIT) until the ratings table shows it.
+
+    The change may sit in another worker's queue, so this looks at the table
+    rather than at this process's queue.
+    """
+    pending = session.get("rating_writes")
+    if not pending or str(barber_id) not in pending:
+        return
+    expected = pending[str(barber_id)]
+    deadline = time.monotonic() + RATING_WRITE_WAIT
+    while True:
+        row = db.execute("""
+            SELECT rating, comment, photo FROM ratings
+            WHERE user_id = ? AND barber_id = ?
+        """, (session["user_id"], barber_id)).fetchone()
+        current = None if row is None else [row["rating"], row["comment"], row["photo"]]
+        if current == expected or time.monotonic() >= deadline:
+            break
+        # woken early when this process's writer commits
+        rating_writes.wait_for_commit(0.02)
+    pending = dict(pending)
+    del pending[str(barber_id)]
+    session["rating_writes"] = pending
+
 # Rate a barber
 @app.route("/rate/<int:barber_id>", methods=["POST"])
 def rate_barber(barber_id):
@@ -276,44 +1318,55 @@ def rate_barber(barber_id):
         return redirect(url_for("barber_detail", barber_id=barber_id))
 
     # Convert rating to integer and get comment
-    rating = int(rating_str)
+    try:
+        rating = int(rating_str)
+    except ValueError:
+        rating = None
+    if rating not in (1, 2, 3, 4, 5):
+        flash("Please select a rating.")
+        return redirect(url_for("barber_detail", barber_id=barber_id))
     comment = request.form.get("comment", "").strip()
     user_id = session["user_id"]
 
+    db = get_db_connection()
+    write_behind_mode = app.config["RATING_WRITE_BEHIND"]
+
+    # the writer cannot report errors back to the user, so check now
+    if write_behind_mode and db.execute("SELECT 1 FROM barbers WHERE id = ?", (barber_id,)).fetchone() is None:
+        return "Barber not found", 404
+
     # Upload Image of Haircut
     haircut_photo = request.files.get("photo")
     photo_path = None
-    
+
     if haircut_photo and haircut_photo.filename:
-        # Save uploaded photo
-        filename = f"{barber_id}_{user_id}_{haircut_photo.filename}"
-        photo_path = "static/barber_images/" + filename
-        haircut_photo.save(photo_path)
+        # Store resized copies of the uploaded photo (once per distinct picture)
+        try:
+            photo_path = store_uploaded_photo(db, haircut_photo.stream, barber_id)
+        except images.InvalidImage:
+            flash("That file is not an image we can read.")
+            return redirect(url_for("barber_detail", barber_id=barber_id))
 
-    db = get_db_connection()
-    # Check if user has already rated this barber
-    existing = db.execute("""
-        SELECT id FROM ratings
-        WHERE user_id = ? AND barber_id = ?
-    """, (user_id, barber_id)).fetchone()
-    # If so, update the existing rating; otherwise, insert a new one
-    if existing:
-        db.execute("""
-            UPDATE ratings
-            SET rating = ?, comment = ?, photo = ?
-            WHERE id = ?
-        """, (rating, comment, photo_path, existing["id"]))
+    change = RatingChange(user_id, barber_id, rating, comment, photo_path)
+    if write_behind_mode:
+        # keep the photo referenced (safe from collect_garbage) until the writer stores the rating
+        if photo_path:
+            db.commit()
+            job_runner.wake()
+        queue_rating_change(change)
+        flash("Thanks for your rating!")
+        return redirect(url_for("barber_detail", barber_id=barber_id))
+
+    previous = apply_rating_change(db, change)
+    if previous:
         flash("Your rating has been updated!")
-    # New rating
     else:
-        db.execute("""
-            INSERT INTO ratings (user_id, barber_id, rating, comment, photo)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, barber_id, rating, comment, photo_path))
         flash("Thanks for your rating g!")
     
     db.commit()
-    db.close()
+    bump_data_version(f"barber:{barber_id}")
+    # resizing the photo and deleting replaced photo files run as jobs
+    job_runner.wake()
     
     return redirect(url_for("barber_detail", barber_id=barber_id))
 
@@ -326,28 +1379,101 @@ def delete_rating(barber_id):
         return redirect(url_for("login"))
     
     user_id = session["user_id"]
+    change = RatingChange(user_id, barber_id, None, None, None)
+
+    # queued behind the user's earlier ratings, so it cannot be overtaken by them
+    if app.config["RATING_WRITE_BEHIND"]:
+        queue_rating_change(change)
+        flash("Your rating has been deleted.")
+        return redirect(url_for("barber_detail", barber_id=barber_id))
+
     db = get_db_connection()
-    
-    # Check if user has rated this barber
-    existing = db.execute("""
-                          SELECT id FROM ratings WHERE user_id = ? AND barber_id = ?
-                          """, (user_id, barber_id)).fetchone()
-    
-    # If so, delete the rating
-    if existing:
-        db.execute("DELETE FROM ratings WHERE user_id = ? AND barber_id = ?", (user_id, barber_id))
+    previous = apply_rating_change(db, change)
+    if previous:
         flash("Your rating has been deleted.")
     else:
         flash("No rating found to delete.")
     
     db.commit()
-    db.close()
+    bump_data_version(f"barber:{barber_id}")
+    job_runner.wake()
     
     flash("Your rating has been deleted.")
     return redirect(url_for("barber_detail", barber_id=barber_id))
 
+# Leaderboard: best and trending barbers, globally or for one shop.
+# Both orders are read straight from indexes on barber_rating_stats (see ranking.py).
+LEADERBOARD_SIZE = 10
+LEADERBOARD_MAX_SIZE = 100
+
+def fetch_leaderboard(db, kind, shop_id=None, limit=LEADERBOARD_SIZE):
+    """Top barbers by "top" (smoothed average) or "trending" (recent stars)."""
+    column = "bayes_score" if kind == "top" else "trend_log"
+    where = f"WHERE stats.{column} IS NOT NULL"
+    params = []
+    if shop_id is not None:
+        where += " AND stats.shop_id = ?"
+        params.append(shop_id)
+    rows = db.execute(f"""
+        SELECT
+            stats.barber_id,
+            barbers.name  AS barber_name,
+            shops.name    AS shop_name,
+            stats.rating_sum,
+            stats.rating_count,
+            stats.bayes_score,
+            stats.trend_log
+        FROM barber_rating_stats AS stats
+        JOIN barbers ON barbers.id = stats.barber_id
+        JOIN shops ON shops.id = barbers.shop_id
+        {where}
+        ORDER BY stats.{column} DESC
+        LIMIT ?
+    """, (*params, limit)).fetchall()
+
+    return [
+        {
+            "barber_id": row["barber_id"],
+            "barber_name": row["barber_name"],
+            "shop_name": row["shop_name"],
+            "avg_rating": row["rating_sum"] / row["rating_count"],
+            "count_ratings": row["rating_count"],
+            "score": row["bayes_score"],
+            "trending": ranking.trend_value(row["trend_log"]),
+        }
+        for row in rows
+    ]
+
+def leaderboard_args():
+    shop_id = request.args.get("shop_id", type=int)
+    limit = request.args.get("limit", LEADERBOARD_SIZE, type=int)
+    return shop_id, max(1, min(limit, LEADERBOARD_MAX_SIZE))
+
+@app.route("/leaderboard")
+def leaderboard():
+    shop_id, limit = leaderboard_args()
+    db = get_read_connection()
+    return render_template(
+        "leaderboard.html",
+        top=fetch_leaderboard(db, "top", shop_id, limit),
+        trending=fetch_leaderboard(db, "trending", shop_id, limit),
+        shops=[entry["shop"] for entry in get_shop_directory()],
+        shop_id=shop_id,
+        user=session.get("username")
+    )
+
+@app.route("/leaderboard/data")
+def leaderboard_data():
+    shop_id, limit = leaderboard_args()
+    db = get_read_connection()
+    return jsonify({
+        "top": fetch_leaderboard(db, "top", shop_id, limit),
+        "trending": fetch_leaderboard(db, "trending", shop_id, limit),
+    })
+
 # About page
 @app.route("/about")
+@cached_page()
 def about():
     return render_template("about.html")
 
@@ -355,25 +1481,377 @@ def about():
 def map_page():
     return render_template("map.html")
 
+# Shop search
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+
+def rebuild_shop_search(db):
+    """Refill the shop_search full-text index from shops and barbers."""
+    db.execute("DELETE FROM shop_search")
+    db.execute("""
+        INSERT INTO shop_search (rowid, name, location, description, barber_names)
+        SELECT
+            shops.id, shops.name, shops.location, shops.description,
+            COALESCE((SELECT group_concat(barbers.name, ' ') FROM barbers WHERE barbers.shop_id = shops.id), '')
+        FROM shops
+    """)
+
+def search_words(query):
+    """Split a search box query into lowercase words the index understands."""
+    return re.findall(r"\w+", query.lower())
+
+def fts_prefix_query(word_options):
+    """
+    Turn [[word, ...], ...] into an FTS5 MATCH expression.
+    Every position must match (AND), any option at a position may match (OR),
+    and every word is a prefix so "barb" finds "barber".
+    """
+    groups = []
+    for options in word_options:
+        groups.append("(" + " OR ".join(f'"{word}"*' for word in options) + ")")
+    return " AND ".join(groups)
+
+SEARCH_TERMS_SQL = """
+    SELECT term FROM shop_search_terms
+    WHERE term >= ? AND term < ?
+    LIMIT 5000
+"""
+
+SEARCH_SHOPS_SQL = """
+    SELECT
+        shops.name, shops.latitude, shops.longitude,
+        shop_search.location AS search_location,
+        shop_search.description AS search_description,
+        shop_search.barber_names AS search_barber_names
+    FROM shop_search
+    JOIN shops ON shops.id = shop_search.rowid
+    WHERE shop_search MATCH ?
+      AND shops.latitude IS NOT NULL AND shops.longitude IS NOT NULL
+    ORDER BY bm25(shop_search, 10.0, 2.0, 1.0, 5.0)
+    LIMIT ?
+"""
+
+def search_terms_range(word):
+    """Bounds of the vocabulary slice sharing the first letter of 'word'."""
+    first = word[0]
+    return first, chr(ord(first) + 1)
+
+def close_matches(word, terms):
+    """Pick the indexed terms that look like a misspelling of 'word'."""
+    # compare against prefixes of the same length, the user may still be typing
+    prefixes = {term[:len(word)] for term in terms}
+    return difflib.get_close_matches(word, prefixes, n=3, cutoff=0.75)
+
+def close_search_terms(db, word):
+    """
+    Return indexed words that look like a misspelling of 'word'.
+
+    Only terms sharing the first letter are considered, so a lookup reads
+    one slice of the vocabulary instead of every shop.
+    """
+    candidates = db.execute(SEARCH_TERMS_SQL, search_terms_range(word)).fetchall()
+    return close_matches(word, [row["term"] for row in candidates])
+
+def find_shops(db, query, limit):
+    """Return geocoded shops matching 'query', best matches first."""
+    words = search_words(query)
+    if not words:
+        return []
+
+    rows = db.execute(SEARCH_SHOPS_SQL, (fts_prefix_query([[word] for word in words]), limit)).fetchall()
+    if rows:
+        return rows
+
+    # nothing found: retry with each word swapped for its closest indexed spellings
+    word_options = []
+    for word in words:
+        options = close_search_terms(db, word)
+        if not options:
+            return []
+        word_options.append(options)
+    return db.execute(SEARCH_SHOPS_SQL, (fts_prefix_query(word_options), limit)).fetchall()
+
+def search_results_json(rows):
+    """
+    Search hits as {"name": ..., "location": "lat,lon", "terms": "..."} for map.html.
+
+    'terms' lists the indexed words of the shop, so the browser can narrow
+    these results itself while the user keeps typing (static/shop_search.js).
+    """
+    return [
+        {
+            "name": row["name"],
+            "location": f"{row['latitude']},{row['longitude']}",
+            "terms": " ".join(sorted(set(search_words(" ".join((
+                row["name"], row["search_location"] or "",
+                row["search_description"] or "", row["search_barber_names"] or "",
+            )))))),
+        }
+        for row in rows
+    ]
+
+# suggestions may be reused for a minute; after that the ETag makes revalidating cheap
+SEARCH_CACHE_CONTROL = "public, max-age=60"
+
+def search_limit(value):
+    return max(1, min(value if value is not None else SEARCH_LIMIT, SEARCH_MAX_LIMIT))
+
 @app.route("/search_shops")
 def search_shops():
     query = request.args.get("query", "").strip()
     if not query:
         return jsonify([])
 
-    conn = get_db_connection()
-    shops_data = conn.execute("SELECT name, latitude, longitude FROM shops WHERE latitude IS NOT NULL AND longitude IS NOT NULL").fetchall()
+    limit = search_limit(request.args.get("limit", type=int))
+
+    conn = get_read_connection()
+    shops_data = find_shops(conn, query, limit)
+    response = jsonify(search_results_json(shops_data))
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest()[:16])
+    response.headers["Cache-Control"] = SEARCH_CACHE_CONTROL
+    return response.make_conditional(request)
+
+# Spatial shop lookups for the map
+NEARBY_RADIUS_M = 1000
+NEARBY_MAX_RADIUS_M = 50000
+MAP_SHOP_LIMIT = 200
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE_LAT = 111320
+
+def rebuild_shop_locations(db):
+    """Refill the shop_locations R*Tree from the shops table."""
+    db.execute("DELETE FROM shop_locations")
+    db.execute("""
+        INSERT INTO shop_locations (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT id, latitude, latitude, longitude, longitude
+        FROM shops
+        WHERE typeof(latitude) IN ('real', 'integer') AND typeof(longitude) IN ('real', 'integer')
+    """)
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """Recompute the shop_search and shop_locations indexes from scratch."""
+    conn = open_db_connection()
+    rebuild_shop_search(conn)
+    rebuild_shop_locations(conn)
+    conn.commit()
     conn.close()
+    print("Rebuilt the shop search and map indexes.")
 
-    # Convert to {"name": ..., "location": "lat,lon"} format
-    all_shops = [
-        {"name": row["name"], "location": f"{row['latitude']},{row['longitude']}"}
-        for row in shops_data
-    ]
+def distance_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in meters (haversine)."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def shops_in_bbox(db, south, west, north, east, limit):
+    """Return shops whose coordinates fall inside the box, using the R*Tree."""
+    return db.execute("""
+        SELECT shops.id, shops.name, shops.location, shops.latitude, shops.longitude
+        FROM shop_locations
+        JOIN shops ON shops.id = shop_locations.id
+        WHERE shop_locations.max_lat >= ? AND shop_locations.min_lat <= ?
+          AND shop_locations.max_lon >= ? AND shop_locations.min_lon <= ?
+          AND shops.latitude BETWEEN ? AND ?
+          AND shops.longitude BETWEEN ? AND ?
+        LIMIT ?
+    """, (south, north, west, east, south, north, west, east, limit)).fetchall()
+
+def shop_json(row):
+    """JSON shape used by the map endpoints for one shop."""
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "address": row["location"],
+        "latitude": row["latitude"],
+        "longitude": row["longitude"],
+    }
 
-    query_lower = query.lower()
-    result = [shop for shop in all_shops if query_lower in shop["name"].lower()]
-    return jsonify(result)
+@app.route("/shops/near")
+def shops_near():
+    """Shops within 'radius' meters of lat/lon, closest first."""
+    lat = request.args.get("lat", type=float)
+    lon = request.args.get("lon", type=float)
+    radius = request.args.get("radius", NEARBY_RADIUS_M, type=float)
+    limit = request.args.get("limit", MAP_SHOP_LIMIT, type=int)
+    if lat is None or lon is None or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        return jsonify({"error": "lat and lon are required"}), 400
+    radius = max(1, min(radius, NEARBY_MAX_RADIUS_M))
+    limit = max(1, min(limit, MAP_SHOP_LIMIT))
+
+    # the R*Tree narrows it down to the bounding box of the circle,
+    # exact distances are only computed for those candidates
+    dlat = radius / METERS_PER_DEGREE_LAT
+    dlon = radius / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+    db = get_read_connection()
+    candidates = db.execute("""
+        SELECT shops.id, shops.name, shops.location, shops.latitude, shops.longitude
+        FROM shop_locations
+        JOIN shops ON shops.id = shop_locations.id
+        WHERE shop_locations.max_lat >= ? AND shop_locations.min_lat <= ?
+          AND shop_locations.max_lon >= ? AND shop_locations.min_lon <= ?
+    """, (lat - dlat, lat + dlat, lon - dlon, lon + dlon)).fetchall()
+
+    result = []
+    for row in candidates:
+        distance = distance_m(lat, lon, row["latitude"], row["longitude"])
+        if distance <= radius:
+            shop = shop_json(row)
+            shop["distance_m"] = round(distance)
+            result.append(shop)
+    result.sort(key=lambda shop: shop["distance_m"])
+    return jsonify(result[:limit])
+
+@app.route("/shops/bbox")
+def shops_bbox():
+    """Shops inside the map viewport given as south/west/north/east."""
+    south = request.args.get("south", type=float)
+    west = request.args.get("west", type=float)
+    north = request.args.get("north", type=float)
+    east = request.args.get("east", type=float)
+    limit = request.args.get("limit", MAP_SHOP_LIMIT, type=int)
+    if None in (south, west, north, east) or south > north or west > east:
+        return jsonify({"error": "south, west, north and east are required"}), 400
+    limit = max(1, min(limit, MAP_SHOP_LIMIT))
+
+    db = get_read_connection()
+    rows = shops_in_bbox(db, south, west, north, east, limit)
+    return jsonify([shop_json(row) for row in rows])
+
+# Map tiles: shops pre-clustered per slippy-map tile (z/x/y), as GeoJSON
+TILE_MAX_ZOOM = 20
+CLUSTER_MAX_ZOOM = 16
+CLUSTER_GRID = 8
+TILE_CACHE_SIZE = 4096
+
+# (z, x, y) -> (expires_at, encoded GeoJSON), least recently used first.
+# Like the shop directory, tiles expire after SHOP_CACHE_TTL seconds, so shops added
+# through another worker or 'flask import-data' appear on this worker's map too.
+_tile_cache = OrderedDict()
+_tile_cache_lock = threading.Lock()
+# bumped on every invalidation so a tile built from old data is not cached
+_tile_generation = 0
+
+def tile_bounds(z, x, y):
+    """Return (south, west, north, east) of a web-mercator tile."""
+    n = 2 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+def tile_for_point(z, lat, lon):
+    """Return the (x, y) of the tile at zoom z containing lat/lon."""
+    n = 2 ** z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def build_tile(db, z, x, y):
+    """
+    Build the GeoJSON FeatureCollection for one tile.
+
+    Below CLUSTER_MAX_ZOOM the tile is cut into a CLUSTER_GRID x CLUSTER_GRID grid
+    and each cell becomes one feature (a cluster with a count and centroid, or the
+    shop itself if it is alone), so the payload size does not depend on how many
+    shops there are. Above it every shop is sent individually.
+    """
+    south, west, north, east = tile_bounds(z, x, y)
+    # R*Tree finds the candidates; the half-open check puts every shop in exactly one tile
+    where = """
+        WHERE shop_locations.max_lat >= :south AND shop_locations.min_lat <= :north
+          AND shop_locations.max_lon >= :west AND shop_locations.min_lon <= :east
+          AND shops.latitude >= :south AND shops.latitude < :north
+          AND shops.longitude >= :west AND shops.longitude < :east
+    """
+    params = {"south": south, "west": west, "north": north, "east": east}
+
+    if z >= CLUSTER_MAX_ZOOM:
+        rows = db.execute("""
+            SELECT 1 AS count, shops.id, shops.name, shops.location, shops.latitude, shops.longitude
+            FROM shop_locations
+            JOIN shops ON shops.id = shop_locations.id
+        """ + where, params).fetchall()
+    else:
+        params["cell_w"] = (east - west) / CLUSTER_GRID
+        params["cell_h"] = (north - south) / CLUSTER_GRID
+        # with MIN(), SQLite fills the bare columns from the row holding the minimum,
+        # which gives the shop details for single-shop cells
+        rows = db.execute("""
+            SELECT
+                COUNT(*)             AS count,
+                MIN(shops.id)        AS id,
+                shops.name           AS name,
+                shops.location       AS location,
+                AVG(shops.latitude)  AS latitude,
+                AVG(shops.longitude) AS longitude
+            FROM shop_locations
+            JOIN shops ON shops.id = shop_locations.id
+        """ + where + """
+            GROUP BY CAST((shops.longitude - :west) / :cell_w AS INTEGER),
+                     CAST((shops.latitude - :south) / :cell_h AS INTEGER)
+        """, params).fetchall()
+
+    features = []
+    for row in rows:
+        if row["count"] == 1:
+            properties = {"cluster": False, "id": row["id"], "name": row["name"], "address": row["location"]}
+        else:
+            properties = {"cluster": True, "count": row["count"]}
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [row["longitude"], row["latitude"]]},
+            "properties": properties,
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+def invalidate_map_tiles(lat=None, lon=None):
+    """
+    Drop cached tiles after shops change.
+    With coordinates, only the tiles containing that point (one per zoom) are dropped.
+    """
+    global _tile_generation
+    with _tile_cache_lock:
+        _tile_generation += 1
+        if lat is None or lon is None:
+            _tile_cache.clear()
+            return
+        for z in range(TILE_MAX_ZOOM + 1):
+            x, y = tile_for_point(z, lat, lon)
+            _tile_cache.pop((z, x, y), None)
+
+@app.route("/shops/tiles/<int:z>/<int:x>/<int:y>.json")
+def shop_tile(z, x, y):
+    if z > TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return jsonify({"error": "tile out of range"}), 404
+
+    key = (z, x, y)
+    body = None
+    with _tile_cache_lock:
+        entry = _tile_cache.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del _tile_cache[key]
+        elif entry is not None:
+            _tile_cache.move_to_end(key)
+            body = entry[1]
+        generation = _tile_generation
+
+    if body is None:
+        # the database, not the snapshot: tiles may stay cached for SHOP_CACHE_TTL
+        body = json.dumps(build_tile(get_db_connection(), z, x, y), separators=(",", ":"))
+        with _tile_cache_lock:
+            if generation != _tile_generation:
+                return app.response_class(body, mimetype="application/json")
+            _tile_cache[key] = (time.monotonic() + SHOP_CACHE_TTL, body)
+            if len(_tile_cache) > TILE_CACHE_SIZE:
+                _tile_cache.popitem(last=False)
+
+    return app.response_class(body, mimetype="application/json")
 
 @app.route("/upload_shop", methods=["GET", "POST"])
 def upload_shop():
@@ -385,13 +1863,29 @@ def upload_shop():
         longitude = request.form["longitude"]
         website = request.form["website"]
         description = request.form["description"]
+
+        # coordinates must be numbers so the shop can be placed on the map
+        try:
+            latitude = float(latitude)
+            longitude = float(longitude)
+        except ValueError:
+            error = "Latitude and longitude must be numbers, e.g. 42.3719 and -71.1193."
+            return render_template("Upload_shop.html", error=error)
+        # float() also accepts "nan", "inf" and "1e400"; outside these ranges no map query finds the shop
+        if not (math.isfinite(latitude) and math.isfinite(longitude)
+                and -90 <= latitude <= 90 and -180 <= longitude <= 180):
+            error = "Latitude must be between -90 and 90 and longitude between -180 and 180."
+            return render_template("Upload_shop.html", error=error)
+
         db = get_db_connection()
         db.execute(
             "INSERT INTO shops (name, location, latitude, longitude, website, description) VALUES (?, ?, ?, ?, ?, ?)",
             (name, address, latitude, longitude, website, description)
         )
         db.commit()
-        db.close()
+        invalidate_shop_directory()
+        invalidate_map_tiles(latitude, longitude)
+        bump_data_version("shops")
         return redirect(url_for("barbers"))
     return render_template("Upload_shop.html")
 
@@ -416,7 +1910,6 @@ def upload_barber():
             error = "Barber name and shop are required."
             # load shops for re-rendering the form with an error
             shops = db.execute("SELECT id, name FROM shops ORDER BY name ASC").fetchall()
-            db.close()
             return render_template("Upload_barber.html", shops=shops, error=error)
 
         # insert into barbers table
@@ -425,14 +1918,65 @@ def upload_barber():
             (barber_name, shop_id)
         )
         db.commit()
-        db.close()
+        invalidate_shop_directory()
+        bump_data_version("shops")
         return redirect(url_for("barbers"))
 
     # GET - render form with shops list
     shops = db.execute("SELECT id, name FROM shops ORDER BY name ASC").fetchall()
-    db.close()
     return render_template("Upload_barber.html", shops=shops)
 
+# Bulk import/export of shops, barbers and ratings (CSV or NDJSON), see bulk.py.
+# Command line only: an import can write any user's ratings and overwrite rows by id,
+# and an export lists every user's ratings, so neither is served over HTTP.
+
+def import_data(db, kind, rows):
+    """Import rows and refresh everything derived from them. Returns a bulk.ImportResult."""
+    before_commit = None
+    if kind == "ratings":
+        # rating stats are recomputed for the batch's barbers in the same transaction
+        before_commit = lambda db, batch: rebuild_rating_stats(db, {params[1] for params in batch})
+    result = bulk.import_rows(db, kind, rows, before_commit=before_commit)
+
+    if kind == "ratings":
+        bump_data_version(*(f"barber:{barber_id}" for barber_id in result.barber_ids))
+    elif result.imported:
+        invalidate_shop_directory()
+        if kind == "shops":
+            invalidate_map_tiles()
+        bump_data_version("shops")
+    return result
+
+@app.cli.command("import-data")
+@click.argument("kind", type=click.Choice(bulk.KINDS))
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(bulk.FORMATS), help="Default: from the file name, else csv.")
+def import_data_command(kind, file, fmt):
+    """Load shops, barbers or ratings from a CSV or NDJSON file ('-' for stdin)."""
+    fmt = fmt or bulk.guess_format(file.name)
+    conn = open_db_connection()
+    start = time.perf_counter()
+    result = import_data(conn, kind, bulk.read_rows(file, fmt))
+    conn.close()
+    print(f"Imported {result.imported} {kind} in {time.perf_counter() - start:.1f}s, {result.error_count} rows skipped.")
+    for error in result.errors:
+        print(f"  line {error['line']}: {error['error']}")
+
+@app.cli.command("export-data")
+@click.argument("kind", type=click.Choice(bulk.KINDS))
+@click.argument("file", type=click.File("w", encoding="utf-8"), default="-")
+@click.option("--format", "fmt", type=click.Choice(bulk.FORMATS), help="Default: from the file name, else csv.")
+def export_data_command(kind, file, fmt):
+    """Write all shops, barbers or ratings as CSV or NDJSON (default: stdout)."""
+    fmt = fmt or bulk.guess_format(file.name)
+    conn = open_db_connection()
+    for chunk in bulk.format_rows(kind, bulk.export_rows(conn, kind), fmt):
+        file.write(chunk)
+    conn.close()
+
+# make sure derived tables exist before the first request
+init_db()
+
 if __name__== "__main__":
     app.run(debug=True)
 
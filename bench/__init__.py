@@ -0,0 +1,25 @@
+"""
+Benchmarks for CrimCutz.
+
+    python -m bench.seed --scale small            # build bench/bench.db
+    python -m bench.run --mode client             # Flask test client, in process
+    python -m bench.run --mode gunicorn -c 16     # real HTTP against a local gunicorn
+    python -m bench.compare OLD.json NEW.json     # latency/throughput change per scenario
+
+Every run is saved under bench/results/ with the commit it measured, so two
+commits can be compared by running the same command on each.
+"""
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_DATABASE = os.path.join(BENCH_DIR, "bench.db")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# every seeded user has this password
+PASSWORD = "benchpass"
+
+
+def use_database(path):
+    """Point the app at 'path'; must run before app.py is imported."""
+    os.environ["CRIMCUTS_DATABASE"] = os.path.abspath(path)
@@ -0,0 +1,48 @@
+"""
+Compare two benchmark result files.
+
+    python -m bench.compare bench/results/OLD.json bench/results/NEW.json
+
+Prints each scenario's latency percentiles and throughput side by side with
+the change in percent; a positive latency change is a slowdown.
+"""
+import argparse
+import json
+
+METRICS = ("p50_ms", "p95_ms", "p99_ms", "throughput_rps")
+
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return "    n/a"
+    return f"{(new - old) / old * 100:+6.1f}%"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("old")
+    parser.add_argument("new")
+    args = parser.parse_args(argv)
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print(f"old: {old['commit']} ({old['mode']}, {old['time']})")
+    print(f"new: {new['commit']} ({new['mode']}, {new['time']})")
+    if old["mode"] != new["mode"] or old["config"] != new["config"]:
+        print("warning: the runs used different settings, compare with care")
+    print()
+
+    for name in new["results"]:
+        if name not in old["results"]:
+            continue
+        print(name)
+        for metric in METRICS:
+            a, b = old["results"][name][metric], new["results"][name][metric]
+            print(f"  {metric:15} {a!s:>10} -> {b!s:>10}  {change(a, b)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Drive the main routes and report latency percentiles and throughput.
+
+    python -m bench.run --mode client --requests 500
+    python -m bench.run --mode gunicorn --workers 2 --threads 4 --concurrency 16
+
+'client' calls the Flask app in process through its test client (no network,
+good for spotting slower code); 'gunicorn' starts a local gunicorn on the
+benchmark database and sends real HTTP requests from 'concurrency' threads.
+Each scenario runs 'requests' requests after a short warm-up; results are
+printed and saved to bench/results/ (see bench.compare).
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from bench import DEFAULT_DATABASE, PASSWORD, REPO_DIR, RESULTS_DIR, use_database
+from bench.seed import NAME_WORDS, SHOP_WORDS
+
+SCENARIOS = ("barbers", "barber_detail", "search_shops", "rate", "login")
+
+
+class Dataset:
+    """Ids the scenarios pick from, read from the benchmark database."""
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise SystemExit(f"{path} does not exist, run: python -m bench.seed")
+        db = sqlite3.connect(path)
+        self.barbers = db.execute("SELECT MAX(id) FROM barbers").fetchone()[0]
+        self.users = db.execute("SELECT MAX(id) FROM users").fetchone()[0]
+        db.close()
+        if not self.barbers or not self.users:
+            raise SystemExit(f"{path} has no data, run: python -m bench.seed")
+
+    def search_query(self, rng):
+        """What someone types: the start of one or two words of a shop name."""
+        words = [rng.choice(NAME_WORDS + SHOP_WORDS) for _ in range(rng.choice((1, 1, 2)))]
+        words[-1] = words[-1][:rng.randint(2, len(words[-1]))]
+        return " ".join(words)
+
+
+def scenario_request(name, data, rng, user_id):
+    """(method, path, form) for one request of a scenario."""
+    if name == "barbers":
+        return "GET", "/barbers", None
+    if name == "barber_detail":
+        return "GET", f"/barbers/{rng.randint(1, data.barbers)}", None
+    if name == "search_shops":
+        return "GET", "/search_shops?" + urlencode({"query": data.search_query(rng)}), None
+    if name == "rate":
+        return "POST", f"/rate/{rng.randint(1, data.barbers)}", {"rating": str(rng.randint(1, 5)), "comment": "benchmark"}
+    if name == "login":
+        return "POST", "/login", {"username": f"bench{user_id}", "password": PASSWORD}
+    raise ValueError(name)
+
+
+class TestClientSession:
+    """One simulated user talking to the app in process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form):
+        response = self.client.open(path, method=method, data=form)
+        response.close()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class HTTPSession:
+    """One simulated user talking to gunicorn; keeps the session cookie."""
+
+    def __init__(self, host, port):
+        self.conn = http.client.HTTPConnection(host, port, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, form):
+        headers = {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (ConnectionError, http.client.HTTPException):
+            # the server closed a kept-alive connection; reconnect and retry once
+            self.conn.close()
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            response.read()
+        set_cookie = response.getheader("Set-Cookie")
+        if set_cookie:
+            self.cookie = set_cookie.split(";", 1)[0]
+        return response.status
+
+    def close(self):
+        self.conn.close()
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, errors, wall_seconds):
+    ordered = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "mean_ms": ms(sum(ordered) / len(ordered)) if ordered else None,
+        "max_ms": ms(ordered[-1]) if ordered else None,
+        "throughput_rps": round(len(ordered) / wall_seconds, 1) if wall_seconds else None,
+    }
+
+
+def run_scenario(name, data, sessions, total, warmup, seed):
+    """Run 'total' requests of one scenario spread over the sessions (one thread each)."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_session = [total // len(sessions) + (i < total % len(sessions)) for i in range(len(sessions))]
+
+    def worker(index):
+        session, user_id = sessions[index]
+        rng = random.Random(seed * 1000 + index)
+        local = []
+        local_errors = 0
+        try:
+            for _ in range(warmup):
+                session.request(*scenario_request(name, data, rng, user_id))
+        except BaseException:
+            # do not leave the other threads waiting for us
+            barrier.abort()
+            raise
+        barrier.wait()
+        for _ in range(per_session[index]):
+            request = scenario_request(name, data, rng, user_id)
+            start = time.perf_counter()
+            status = session.request(*request)
+            local.append(time.perf_counter() - start)
+            if status >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    # every thread starts measuring at the same moment, after its warm-up
+    started = []
+    barrier = threading.Barrier(len(sessions), action=lambda: started.append(time.perf_counter()))
+    with ThreadPoolExecutor(len(sessions)) as pool:
+        futures = [pool.submit(worker, i) for i in range(len(sessions))]
+        for future in futures:
+            future.result()
+        wall = time.perf_counter() - started[0]
+    return summarize(latencies, errors[0], wall)
+
+
+def log_in(session, user_id):
+    status = session.request("POST", "/login", {"username": f"bench{user_id}", "password": PASSWORD})
+    if status != 302:
+        raise SystemExit(f"Could not log in as bench{user_id} (status {status})")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(args, port):
+    env = dict(os.environ)
+    command = [
+        sys.executable, "-m", "gunicorn",
+        "--workers", str(args.workers), "--threads", str(args.threads),
+        "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "app:app",
+    ]
+    process = subprocess.Popen(command, cwd=REPO_DIR, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("gunicorn exited during startup")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("gunicorn did not start within 30s")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip() + ("+dirty" if subprocess.run(
+            ["git", "diff", "--quiet", "HEAD"], cwd=REPO_DIR).returncode else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=DEFAULT_DATABASE)
+    parser.add_argument("--mode", choices=("client", "gunicorn"), default="client")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per thread before each scenario")
+    parser.add_argument("-c", "--concurrency", type=int, default=1, help="simulated users sending requests at once")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="results file (default: bench/results/<time>-<commit>-<mode>.json)")
+    args = parser.parse_args(argv)
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    use_database(args.database)
+    data = Dataset(args.database)
+
+    process = None
+    if args.mode == "client":
+        import app as crimcuts
+        make_session = lambda: TestClientSession(crimcuts.app)
+    else:
+        port = free_port()
+        process = start_gunicorn(args, port)
+        make_session = lambda: HTTPSession("127.0.0.1", port)
+
+    # one simulated user per thread, each a different seeded account
+    sessions = []
+    try:
+        sessions += [(make_session(), user_id) for user_id in range(1, args.concurrency + 1)]
+        results = {}
+        for name in scenarios:
+            if name == "rate":
+                for session, user_id in sessions:
+                    log_in(session, user_id)
+            results[name] = run_scenario(name, data, sessions, args.requests, args.warmup, args.seed)
+            r = results[name]
+            print(f"{name:14} {r['requests']:6d} req  p50 {r['p50_ms']:9.2f} ms  p95 {r['p95_ms']:9.2f} ms  "
+                  f"p99 {r['p99_ms']:9.2f} ms  {r['throughput_rps']:8.1f} req/s  errors {r['errors']}")
+    finally:
+        # open keep-alive connections would hold up gunicorn's graceful shutdown
+        for session, _ in sessions:
+            session.close()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "mode": args.mode,
+        "config": {
+            "database": os.path.basename(args.database),
+            "barbers": data.barbers,
+            "users": data.users,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "workers": args.workers if args.mode == "gunicorn" else None,
+            "threads": args.threads if args.mode == "gunicorn" else None,
+            "password_iterations": os.environ.get("CRIMCUTS_PASSWORD_ITERATIONS"),
+        },
+        "results": results,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{commit.replace('+', '-')}-{args.mode}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
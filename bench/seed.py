@@ -0,0 +1,126 @@
+"""
+Build a synthetic database for the benchmarks.
+
+    python -m bench.seed --scale large                 # 10k shops, 100k barbers, 5M ratings
+    python -m bench.seed --shops 100 --ratings 5000    # or any mix
+
+The schema comes from the app's own migrations, and the derived tables
+(search index, R*Tree, rating stats) are filled the same way the app fills them.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from bench import DEFAULT_DATABASE, PASSWORD, use_database
+
+SCALES = {
+    "small": {"shops": 500, "barbers": 5_000, "users": 2_000, "ratings": 100_000},
+    "medium": {"shops": 2_000, "barbers": 20_000, "users": 10_000, "ratings": 1_000_000},
+    "large": {"shops": 10_000, "barbers": 100_000, "users": 50_000, "ratings": 5_000_000},
+}
+
+# shop names are built from these, so search queries have realistic overlaps
+NAME_WORDS = [
+    "Harvard", "Central", "Kendall", "Porter", "Inman", "Davis", "Union", "Back", "Bay",
+    "Classic", "Modern", "Royal", "Golden", "Sharp", "Fresh", "Urban", "Gentlemen",
+]
+SHOP_WORDS = ["Barbers", "Barber Shop", "Cuts", "Fades", "Clippers", "Grooming", "Studio"]
+FIRST_NAMES = ["Alex", "Ben", "Carlos", "Dmitri", "Eli", "Hicham", "Jake", "Kofi", "Luis", "Mo", "Nick", "Omar", "Sam", "Steven", "Tony", "Yusuf"]
+LAST_NAMES = ["Adams", "Bucci", "Chen", "Diaz", "Evans", "Garcia", "Ito", "Jones", "Khan", "Lopez", "Moreau", "Nguyen", "Okafor", "Silva", "Smith"]
+COMMENTS = [None, None, "Great fade.", "Quick and friendly.", "A bit pricey.", "Best cut in years!", "Waited too long."]
+
+# Cambridge / Boston
+SOUTH, WEST, NORTH, EAST = 42.30, -71.20, 42.42, -71.00
+BATCH = 50_000
+
+
+def shop_name(rng, i):
+    return f"{rng.choice(NAME_WORDS)} {rng.choice(NAME_WORDS)} {rng.choice(SHOP_WORDS)} {i}"
+
+
+def seed(db, rng, shops, barbers, users, ratings, password_hash):
+    now = datetime.now(timezone.utc)
+
+    db.executemany(
+        "INSERT INTO shops (id, name, location, website, description, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            (i, shop_name(rng, i), f"{i} Massachusetts Ave", f"https://shop{i}.example.com",
+             f"{rng.choice(NAME_WORDS)} style cuts and shaves.",
+             rng.uniform(SOUTH, NORTH), rng.uniform(WEST, EAST))
+            for i in range(1, shops + 1)
+        ),
+    )
+    db.executemany(
+        "INSERT INTO barbers (id, name, shop_id) VALUES (?, ?, ?)",
+        ((i, f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}", rng.randint(1, shops)) for i in range(1, barbers + 1)),
+    )
+    # one hash for everybody: hashing 50k passwords would take longer than the benchmark
+    db.executemany(
+        "INSERT INTO users (id, username, password) VALUES (?, ?, ?)",
+        ((i, f"bench{i}", password_hash) for i in range(1, users + 1)),
+    )
+
+    # each user rates a different random set of barbers (one rating per user and barber)
+    per_user, extra = divmod(ratings, users)
+
+    def rating_rows():
+        for user_id in range(1, users + 1):
+            count = min(per_user + (user_id <= extra), barbers)
+            for barber_id in rng.sample(range(1, barbers + 1), count):
+                created_at = now - timedelta(seconds=rng.randint(0, 180 * 86400))
+                yield (user_id, barber_id, rng.randint(1, 5), rng.choice(COMMENTS),
+                       created_at.strftime("%Y-%m-%d %H:%M:%S"))
+
+    rows = rating_rows()
+    inserted = 0
+    while True:
+        batch = [row for _, row in zip(range(BATCH), rows)]
+        if not batch:
+            break
+        db.executemany("INSERT INTO ratings (user_id, barber_id, rating, comment, created_at) VALUES (?, ?, ?, ?, ?)", batch)
+        inserted += len(batch)
+        print(f"\r  ratings: {inserted:,}", end="", file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=DEFAULT_DATABASE)
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    for name in ("shops", "barbers", "users", "ratings"):
+        parser.add_argument(f"--{name}", type=int, help=f"override the number of {name}")
+    parser.add_argument("--seed", type=int, default=1, help="random seed, for reproducible data")
+    args = parser.parse_args(argv)
+
+    sizes = dict(SCALES[args.scale])
+    for name in sizes:
+        if getattr(args, name) is not None:
+            sizes[name] = getattr(args, name)
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(args.database + suffix):
+            os.remove(args.database + suffix)
+    use_database(args.database)
+    # importing the app creates the schema in the new file
+    import app as crimcuts
+
+    # bulk inserts are slow statements by design, keep them out of the slow-query log
+    crimcuts.metrics.log.setLevel(logging.ERROR)
+
+    start = time.perf_counter()
+    password_hash = crimcuts.passwords.hash_password(PASSWORD)
+    db = crimcuts.open_db_connection()
+    seed(db, random.Random(args.seed), password_hash=password_hash, **sizes)
+    crimcuts.rebuild_rating_stats(db)
+    db.commit()
+    db.execute("ANALYZE")
+    db.close()
+    print(f"Seeded {args.database} with {sizes} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
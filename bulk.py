@@ -0,0 +1,322 @@
+"""
+Bulk import and export of shops, barbers and ratings as CSV or NDJSON.
+
+Rows are read one at a time, checked, and written with executemany() in
+batches of BATCH_SIZE, one transaction per batch, so a file of 50k rows is a
+few dozen statements instead of 50k form posts. Bad rows are skipped and
+reported with their line number; the good rows around them are still loaded.
+
+Columns (the export writes the same ones, so an export can be imported again):
+
+    shops     id, name, location, website, description, latitude, longitude
+    barbers   id, name, shop_id, shop   (shop_id, or the shop's exact name)
+    ratings   username, barber_id, rating, comment, created_at
+
+'id' is optional. Rows with an id that already exists update that row, rows
+without one are added. A rating replaces the same user's rating of that barber.
+
+This module does not know about Flask; app.py wires it to the CLI.
+"""
+import csv
+import io
+import json
+import math
+from datetime import datetime, timezone
+
+BATCH_SIZE = 1000
+# errors listed in the result; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+FORMATS = ("csv", "ndjson")
+COLUMNS = {
+    "shops": ("id", "name", "location", "website", "description", "latitude", "longitude"),
+    "barbers": ("id", "name", "shop_id", "shop"),
+    "ratings": ("username", "barber_id", "rating", "comment", "created_at"),
+}
+KINDS = tuple(COLUMNS)
+
+
+class RowError(ValueError):
+    """A row that cannot be imported; the message says why."""
+
+
+def guess_format(filename, default="csv"):
+    """Format from a file name: .ndjson/.jsonl/.json are NDJSON, anything else the default."""
+    if filename and filename.lower().endswith((".ndjson", ".jsonl", ".json")):
+        return "ndjson"
+    return default
+
+
+# Reading
+def read_rows(stream, fmt):
+    """
+    Yield (line_number, row) from a text stream. A row is a dict, or a
+    RowError for a line that could not be parsed at all.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # a row with more fields than the header puts the extras under None
+            if None in row:
+                yield reader.line_num, RowError("too many fields")
+            else:
+                yield reader.line_num, row
+    elif fmt == "ndjson":
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, RowError(f"invalid JSON: {e}")
+                continue
+            yield number, row if isinstance(row, dict) else RowError("expected a JSON object")
+    else:
+        raise ValueError(f"unknown format {fmt!r}")
+
+
+def _text(row, name, required=False, max_length=1000):
+    value = row.get(name)
+    value = "" if value is None else str(value).strip()
+    if required and not value:
+        raise RowError(f"'{name}' is required")
+    if len(value) > max_length:
+        raise RowError(f"'{name}' is longer than {max_length} characters")
+    return value or None
+
+
+def _number(row, name, kind, required=False, low=None, high=None):
+    value = row.get(name)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        if required:
+            raise RowError(f"'{name}' is required")
+        return None
+    try:
+        value = kind(value)
+    except (TypeError, ValueError, OverflowError):
+        raise RowError(f"'{name}' must be a number, got {value!r}")
+    # NaN fails every comparison below, so it would pass the range check
+    if not math.isfinite(value):
+        raise RowError(f"'{name}' must be a finite number, got {value!r}")
+    if (low is not None and value < low) or (high is not None and value > high):
+        raise RowError(f"'{name}' must be between {low} and {high}")
+    return value
+
+
+# Validation, one function per kind: row dict -> parameters for the insert
+class Lookups:
+    """Memoized lookups of referenced rows during one import."""
+
+    def __init__(self, db):
+        self.db = db
+        self.cache = {}
+
+    def _ids(self, key, sql, params):
+        """Up to two matching ids, enough to tell "none", "one" and "several" apart."""
+        if key not in self.cache:
+            self.cache[key] = [row[0] for row in self.db.execute(sql, params).fetchmany(2)]
+        return self.cache[key]
+
+    def shop_id(self, row):
+        shop_id = _number(row, "shop_id", int, low=1)
+        if shop_id is not None:
+            if not self._ids(("shop_id", shop_id), "SELECT id FROM shops WHERE id = ?", (shop_id,)):
+                raise RowError(f"no shop with id {shop_id}")
+            return shop_id
+        name = _text(row, "shop")
+        if name is None:
+            raise RowError("'shop_id' or 'shop' is required")
+        found = self._ids(("shop", name), "SELECT id FROM shops WHERE name = ?", (name,))
+        if not found:
+            raise RowError(f"no shop named {name!r}")
+        if len(found) > 1:
+            raise RowError(f"several shops are named {name!r}, use shop_id")
+        return found[0]
+
+    def user_id(self, row):
+        username = _text(row, "username", required=True)
+        found = self._ids(("user", username), "SELECT id FROM users WHERE username = ?", (username,))
+        if not found:
+            raise RowError(f"no user named {username!r}")
+        return found[0]
+
+    def barber_id(self, row):
+        barber_id = _number(row, "barber_id", int, required=True, low=1)
+        if not self._ids(("barber_id", barber_id), "SELECT id FROM barbers WHERE id = ?", (barber_id,)):
+            raise RowError(f"no barber with id {barber_id}")
+        return barber_id
+
+
+def _shop(row, lookups):
+    latitude = _number(row, "latitude", float, low=-90, high=90)
+    longitude = _number(row, "longitude", float, low=-180, high=180)
+    if (latitude is None) != (longitude is None):
+        raise RowError("give both 'latitude' and 'longitude', or neither")
+    return (
+        _number(row, "id", int, low=1),
+        _text(row, "name", required=True, max_length=200),
+        _text(row, "location"),
+        _text(row, "website"),
+        _text(row, "description", max_length=5000),
+        latitude,
+        longitude,
+    )
+
+
+def _barber(row, lookups):
+    return (
+        _number(row, "id", int, low=1),
+        _text(row, "name", required=True, max_length=200),
+        lookups.shop_id(row),
+    )
+
+
+def _rating(row, lookups):
+    created_at = _text(row, "created_at")
+    if created_at is not None:
+        try:
+            parsed = datetime.fromisoformat(created_at)
+            if parsed.tzinfo is not None:
+                # created_at is stored in UTC, like CURRENT_TIMESTAMP
+                parsed = parsed.astimezone(timezone.utc)
+            created_at = parsed.strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            raise RowError(f"'created_at' must be a date and time, got {created_at!r}")
+    return (
+        lookups.user_id(row),
+        lookups.barber_id(row),
+        _number(row, "rating", int, required=True, low=1, high=5),
+        _text(row, "comment", max_length=5000),
+        created_at,
+    )
+
+
+VALIDATORS = {"shops": _shop, "barbers": _barber, "ratings": _rating}
+
+INSERTS = {
+    "shops": """
+        INSERT INTO shops (id, name, location, website, description, latitude, longitude)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            name = excluded.name, location = excluded.location, website = excluded.website,
+            description = excluded.description, latitude = excluded.latitude, longitude = excluded.longitude
+    """,
+    "barbers": """
+        INSERT INTO barbers (id, name, shop_id) VALUES (?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET name = excluded.name, shop_id = excluded.shop_id
+    """,
+    "ratings": """
+        INSERT INTO ratings (user_id, barber_id, rating, comment, created_at)
+        VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ON CONFLICT(user_id, barber_id) DO UPDATE SET
+            rating = excluded.rating, comment = excluded.comment, created_at = excluded.created_at
+    """,
+}
+
+
+class ImportResult:
+    def __init__(self, kind):
+        self.kind = kind
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+        # barber ids whose ratings changed, for the caller's caches
+        self.barber_ids = set()
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def as_dict(self):
+        return {"kind": self.kind, "imported": self.imported, "errors": self.error_count, "first_errors": self.errors}
+
+
+def import_rows(db, kind, rows, before_commit=None, batch_size=BATCH_SIZE):
+    """
+    Validate and insert rows from read_rows(), one transaction per batch.
+
+    before_commit(db, params) runs inside each batch's transaction after the
+    insert, e.g. to update derived tables for ratings. Returns an ImportResult.
+    """
+    validate = VALIDATORS[kind]
+    lookups = Lookups(db)
+    result = ImportResult(kind)
+    batch = []
+
+    def flush():
+        db.executemany(INSERTS[kind], batch)
+        if before_commit is not None:
+            before_commit(db, batch)
+        db.commit()
+        result.imported += len(batch)
+        batch.clear()
+
+    try:
+        for line, row in rows:
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                params = validate(row, lookups)
+            except RowError as e:
+                result.add_error(line, str(e))
+                continue
+            batch.append(params)
+            if kind == "ratings":
+                result.barber_ids.add(params[1])
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    except Exception:
+        db.rollback()
+        raise
+    return result
+
+
+# Exporting
+EXPORTS = {
+    "shops": "SELECT id, name, location, website, description, latitude, longitude FROM shops ORDER BY id",
+    "barbers": """
+        SELECT barbers.id, barbers.name, barbers.shop_id, shops.name AS shop
+        FROM barbers LEFT JOIN shops ON shops.id = barbers.shop_id
+        ORDER BY barbers.id
+    """,
+    "ratings": """
+        SELECT users.username, ratings.barber_id, ratings.rating, ratings.comment, ratings.created_at
+        FROM ratings JOIN users ON users.id = ratings.user_id
+        ORDER BY ratings.id
+    """,
+}
+
+
+def export_rows(db, kind, batch_size=BATCH_SIZE):
+    """Yield every row of 'kind' as a tuple in COLUMNS order, reading batch_size at a time."""
+    cursor = db.execute(EXPORTS[kind])
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from (tuple(row) for row in rows)
+
+
+def format_rows(kind, rows, fmt, batch_size=BATCH_SIZE):
+    """Yield text chunks of CSV (with a header) or NDJSON, about batch_size rows each."""
+    columns = COLUMNS[kind]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(columns)
+    count = 0
+    for row in rows:
+        if fmt == "csv":
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row))) + "\n")
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,101 @@
+"""
+Haircut photo processing for CrimCutz.
+
+Uploads are decoded once and written as a few resized WebP variants instead of
+being stored byte-for-byte. EXIF and other metadata are dropped (after using the
+orientation tag), so a phone photo of several megabytes becomes three small files:
+
+    <name>_thumb.webp   160px  gallery/list thumbnails
+    <name>_card.webp    480px  the photo slot on the barber page
+    <name>_full.webp   1600px  opened on click / large screens
+
+The database stores the path of the _full variant; photo_variants() gives back
+all of them for templates.
+"""
+import os
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# variant name -> longest side in pixels, largest first
+VARIANTS = {
+    "full": 1600,
+    "card": 480,
+    "thumb": 160,
+}
+WEBP_QUALITY = 80
+# refuse images that would need more memory than this to decode (~200 MB RGBA)
+MAX_PIXELS = 50_000_000
+
+
+class InvalidImage(Exception):
+    """Raised when an upload cannot be decoded as an image."""
+
+
+def _decode(stream):
+    """Decode an uploaded image, upright and in a mode WebP can store."""
+    try:
+        img = Image.open(stream)
+        if img.width * img.height > MAX_PIXELS:
+            raise InvalidImage("image is too large")
+        # let the JPEG decoder downscale while decoding when the original is huge
+        img.draft("RGB", (VARIANTS["full"], VARIANTS["full"]))
+        # apply the EXIF rotation before the metadata is thrown away
+        img = ImageOps.exif_transpose(img)
+        img.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage(str(e))
+
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+    return img
+
+
+def check_image(stream):
+    """
+    Cheap check of an upload without decoding the pixels: the header must be an
+    image we can open, within MAX_PIXELS. Rewinds the stream.
+    Raises InvalidImage otherwise.
+    """
+    try:
+        with Image.open(stream) as img:
+            if img.width * img.height > MAX_PIXELS:
+                raise InvalidImage("image is too large")
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage(str(e))
+    finally:
+        stream.seek(0)
+
+
+def save_image_variants(stream, directory, name):
+    """
+    Decode 'stream' and write every variant into 'directory'.
+
+    Returns the path of the _full variant, the value to store in the database.
+    Raises InvalidImage if the upload is not an image.
+    """
+    img = _decode(stream)
+    os.makedirs(directory, exist_ok=True)
+
+    paths = {}
+    # each variant is resized from the previous, larger one, which is cheaper than the original
+    for variant, size in VARIANTS.items():
+        img = img.copy()
+        img.thumbnail((size, size), Image.LANCZOS)
+        path = os.path.join(directory, f"{name}_{variant}.webp")
+        # no exif=/icc_profile= arguments, so no metadata ends up in the file
+        img.save(path, "WEBP", quality=WEBP_QUALITY, method=4)
+        paths[variant] = path
+    return paths["full"]
+
+
+def photo_variants(photo):
+    """
+    Return {"thumb": path, "card": path, "full": path} for a stored photo path.
+
+    Photos uploaded before variants existed only have the original file,
+    which is then used for every size.
+    """
+    if photo and photo.endswith("_full.webp"):
+        base = photo[: -len("_full.webp")]
+        return {variant: f"{base}_{variant}.webp" for variant in VARIANTS}
+    return {variant: photo for variant in VARIANTS}
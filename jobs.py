@@ -0,0 +1,198 @@
+"""
+Background jobs for CrimCutz, persisted in the 'jobs' table.
+
+Work that does not have to finish before the response (resizing an uploaded
+photo, deleting photo files nothing uses) is queued as a job instead:
+
+    jobs.enqueue(db, "process_photo", {"photo": path})   # in the caller's transaction
+    db.commit()
+    runner.wake()                                         # start it now instead of at the next poll
+
+A job is committed together with the change that needs it, so it is never lost
+and never runs for a change that was rolled back. Handlers are registered by
+kind and get their own transaction, committed with the removal of the job:
+
+    @jobs.handler("process_photo")
+    def process_photo(db, payload): ...
+
+A handler that raises is retried after RETRY_DELAY * 2^(attempt - 1) seconds;
+after max_attempts the job is kept with status 'failed' and its last error.
+Raise JobFailed to give up at once. Jobs whose worker died (the lock expired)
+are picked up again, so handlers must be safe to run twice.
+
+Jobs are run by a JobRunner: a few threads inside each web process, and/or a
+separate worker process (flask --app app jobs-worker). Any number of runners
+can share the table; claiming a job is a single UPDATE, so each job runs once.
+
+This module does not know about Flask; app.py registers the handlers.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger("crimcuts.jobs")
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 5.0
+# a job still 'running' after this many seconds is assumed lost and run again
+LOCK_SECONDS = 300
+POLL_INTERVAL = 1.0
+
+# kind -> handler(db, payload)
+HANDLERS = {}
+
+
+class JobFailed(Exception):
+    """Raised by a handler for an error that retrying will not fix."""
+
+
+def handler(kind):
+    """Register the function that runs jobs of 'kind'."""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(db, kind, payload=None, delay=0, max_attempts=MAX_ATTEMPTS, unique=False):
+    """
+    Add a job; the caller commits. With unique=True nothing is added if the same
+    job (kind and payload) is already waiting to run.
+    """
+    payload = json.dumps(payload or {}, sort_keys=True)
+    now = time.time()
+    if unique:
+        db.execute("""
+            INSERT INTO jobs (kind, payload, max_attempts, run_after, created_at)
+            SELECT ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE status = 'queued' AND kind = ? AND payload = ?)
+        """, (kind, payload, max_attempts, now + delay, now, kind, payload))
+    else:
+        db.execute(
+            "INSERT INTO jobs (kind, payload, max_attempts, run_after, created_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, payload, max_attempts, now + delay, now),
+        )
+
+
+def counts(db):
+    """{status: number of jobs} for the jobs still in the table."""
+    return dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+def retry_failed(db, kind=None):
+    """Queue failed jobs again with fresh attempts; the caller commits. Returns how many."""
+    return db.execute("""
+        UPDATE jobs SET status = 'queued', attempts = 0, run_after = ?
+        WHERE status = 'failed' AND (? IS NULL OR kind = ?)
+    """, (time.time(), kind, kind)).rowcount
+
+
+def claim(db):
+    """Take the next job that is due, or return None. Commits."""
+    now = time.time()
+    # jobs of a runner that died are due again
+    db.execute("""
+        UPDATE jobs SET status = 'queued'
+        WHERE status = 'running' AND locked_until < ?
+    """, (now,))
+    row = db.execute("""
+        UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE status = 'queued' AND run_after <= ?
+            ORDER BY run_after, id
+            LIMIT 1
+        )
+        RETURNING id, kind, payload, attempts, max_attempts
+    """, (now + LOCK_SECONDS, now)).fetchone()
+    db.commit()
+    return row
+
+
+def run_job(db, job):
+    """Run a claimed job. Returns True if it succeeded."""
+    job_id, kind, payload, attempts, max_attempts = job
+    try:
+        func = HANDLERS.get(kind)
+        if func is None:
+            raise JobFailed(f"no handler for job kind {kind!r}")
+        func(db, json.loads(payload))
+        db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        db.commit()
+        return True
+    except Exception as e:
+        db.rollback()
+        give_up = isinstance(e, JobFailed) or attempts >= max_attempts
+        if give_up:
+            log.error("Job %s (%s) failed after %d attempts: %s", job_id, kind, attempts, e, exc_info=True)
+            db.execute(
+                "UPDATE jobs SET status = 'failed', locked_until = NULL, last_error = ? WHERE id = ?",
+                (repr(e), job_id),
+            )
+        else:
+            delay = RETRY_DELAY * 2 ** (attempts - 1)
+            log.warning("Job %s (%s) failed, retrying in %.0fs: %s", job_id, kind, delay, e)
+            db.execute("""
+                UPDATE jobs SET status = 'queued', locked_until = NULL, last_error = ?, run_after = ?
+                WHERE id = ?
+            """, (repr(e), time.time() + delay, job_id))
+        db.commit()
+        return False
+
+
+class JobRunner:
+    """Runs jobs on 'threads' threads, each with its own connection from 'connect'."""
+
+    def __init__(self, connect, threads=1, poll_interval=POLL_INTERVAL):
+        self.connect = connect
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {"succeeded": 0, "failed": 0}
+
+    def start(self):
+        """Start the threads, once per process (again after a fork). Does nothing with threads=0."""
+        with self._lock:
+            if self.threads <= 0 or self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        for number in range(self.threads):
+            threading.Thread(target=self.run, name=f"jobs-{number}", daemon=True).start()
+
+    def wake(self):
+        """Look for due jobs now instead of at the next poll (this process's runner only)."""
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def run(self):
+        """Run jobs until stop() is called; used by the threads and by the CLI worker."""
+        db = self.connect()
+        try:
+            while not self._stopping.is_set():
+                try:
+                    job = claim(db)
+                except Exception:
+                    log.exception("Could not claim a job")
+                    db.rollback()
+                    job = None
+                if job is None:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+                ok = run_job(db, job)
+                with self._lock:
+                    self._stats["succeeded" if ok else "failed"] += 1
+        finally:
+            db.close()
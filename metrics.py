@@ -0,0 +1,268 @@
+"""
+Request and SQL instrumentation for CrimCutz.
+
+Every request and every SQL statement is timed and the totals are kept in
+memory, per worker process, for the Prometheus-style '/metrics' endpoint:
+
+    crimcuts_request_duration_seconds   histogram per route and method
+    crimcuts_requests_total             count per route, method and status
+    crimcuts_sql_duration_seconds       histogram over all statements
+    crimcuts_sql_statements_total       count per statement
+    crimcuts_sql_seconds_total          time per statement
+    crimcuts_sql_queries_per_request    histogram per route
+    crimcuts_sql_repeated_total         requests that ran one statement N_PLUS_ONE_THRESHOLD+ times
+
+The database layer opts in by connecting with factory=ProfiledConnection.
+Statements are timed in execute() and fetchone/fetchmany/fetchall(), where
+SQLite does the work; rows read by iterating a cursor are not timed.
+
+A statement that runs again and again within one request (a query inside a
+loop, the classic N+1) is counted in crimcuts_sql_repeated_total and logged,
+and any statement slower than SLOW_QUERY_SECONDS goes to the slow-query log.
+
+This module does not know about Flask: app.py calls start_request() and
+finish_request() around each request.
+"""
+import bisect
+import contextvars
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SLOW_QUERY_SECONDS = float(os.environ.get("CRIMCUTS_SLOW_QUERY_MS", 100)) / 1000
+N_PLUS_ONE_THRESHOLD = 10
+# statements are labelled by their SQL text, squashed to one line and cut here
+STATEMENT_LABEL_LENGTH = 120
+
+log = logging.getLogger("crimcuts.sql")
+
+
+class Histogram:
+    """Cumulative-bucket histogram; the caller holds the lock."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            running += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f"{name}_bucket", {**labels, "le": le}, running
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, running
+
+
+_lock = threading.Lock()
+_request_durations = defaultdict(lambda: Histogram(REQUEST_BUCKETS))
+_request_counts = Counter()
+_sql_durations = Histogram(SQL_BUCKETS)
+_sql_counts = Counter()
+_sql_seconds = Counter()
+_queries_per_request = defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS))
+_repeated = Counter()
+
+
+class RequestProfile:
+    """SQL run by one request, collected while it is current."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # [statement, seconds] in the order they ran
+        self.statements = []
+        self.counts = Counter()
+
+
+_current = contextvars.ContextVar("crimcuts_request_profile", default=None)
+
+
+def statement_label(sql):
+    return " ".join(sql.split())[:STATEMENT_LABEL_LENGTH]
+
+
+def _record_statement(label, seconds):
+    """Count one statement; returns its [label, seconds] entry in the request profile, if any."""
+    with _lock:
+        _sql_durations.observe(seconds)
+        _sql_counts[label] += 1
+        _sql_seconds[label] += seconds
+    if seconds >= SLOW_QUERY_SECONDS:
+        log.warning("Slow query (%.1f ms): %s", seconds * 1000, label)
+    profile = _current.get()
+    if profile is None:
+        return None
+    entry = [label, seconds]
+    profile.statements.append(entry)
+    profile.counts[label] += 1
+    return entry
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that reports the time of every statement it runs."""
+
+    _label = None
+    _entry = None
+
+    def _timed(self, run, sql, *args):
+        start = time.perf_counter()
+        try:
+            return run(sql, *args)
+        finally:
+            self._label = statement_label(sql)
+            self._entry = _record_statement(self._label, time.perf_counter() - start)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def _timed_fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            # reading the rows is part of the statement that produced them
+            if self._label is not None:
+                seconds = time.perf_counter() - start
+                with _lock:
+                    _sql_seconds[self._label] += seconds
+                if self._entry is not None:
+                    self._entry[1] += seconds
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """sqlite3 connection whose execute() goes through ProfiledCursor."""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def start_request():
+    """Begin collecting SQL for the request running on this thread."""
+    profile = RequestProfile()
+    _current.set(profile)
+    return profile
+
+
+def current_profile():
+    return _current.get()
+
+
+def finish_request(route, method, status):
+    """Record the current request's latency and SQL, and stop collecting."""
+    profile = _current.get()
+    if profile is None:
+        return None
+    _current.set(None)
+    seconds = time.perf_counter() - profile.started
+
+    repeated = [(label, count) for label, count in profile.counts.items() if count >= N_PLUS_ONE_THRESHOLD]
+    with _lock:
+        _request_durations[(route, method)].observe(seconds)
+        _request_counts[(route, method, str(status))] += 1
+        _queries_per_request[route].observe(len(profile.statements))
+        for label, _ in repeated:
+            _repeated[(route, label)] += 1
+    for label, count in repeated:
+        log.warning("%s ran the same statement %d times (N+1?): %s", route, count, label)
+    return profile
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _line(name, labels, value):
+    if labels:
+        inner = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        return f"{name}{{{inner}}} {value}"
+    return f"{name} {value}"
+
+
+def render(extra=None):
+    """
+    Return every metric in the Prometheus text format.
+    'extra' maps metric names to (type, help, value) for gauges kept elsewhere.
+    """
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(_line(*sample) for sample in samples)
+
+    with _lock:
+        family("crimcuts_request_duration_seconds", "histogram", "Time to handle a request.", [
+            sample
+            for (route, method), histogram in sorted(_request_durations.items())
+            for sample in histogram.samples("crimcuts_request_duration_seconds", {"route": route, "method": method})
+        ])
+        family("crimcuts_requests_total", "counter", "Requests handled.", [
+            ("crimcuts_requests_total", {"route": route, "method": method, "status": status}, count)
+            for (route, method, status), count in sorted(_request_counts.items())
+        ])
+        family("crimcuts_sql_duration_seconds", "histogram", "Time of single SQL statements.",
+               list(_sql_durations.samples("crimcuts_sql_duration_seconds", {})))
+        family("crimcuts_sql_statements_total", "counter", "SQL statements run.", [
+            ("crimcuts_sql_statements_total", {"statement": label}, count)
+            for label, count in sorted(_sql_counts.items())
+        ])
+        family("crimcuts_sql_seconds_total", "counter", "Time spent running and fetching each SQL statement.", [
+            ("crimcuts_sql_seconds_total", {"statement": label}, seconds)
+            for label, seconds in sorted(_sql_seconds.items())
+        ])
+        family("crimcuts_sql_queries_per_request", "histogram", "SQL statements run by one request.", [
+            sample
+            for route, histogram in sorted(_queries_per_request.items())
+            for sample in histogram.samples("crimcuts_sql_queries_per_request", {"route": route})
+        ])
+        family("crimcuts_sql_repeated_total", "counter",
+               f"Requests that ran the same statement {N_PLUS_ONE_THRESHOLD} or more times.", [
+            ("crimcuts_sql_repeated_total", {"route": route, "statement": label}, count)
+            for (route, label), count in sorted(_repeated.items())
+        ])
+
+    for name, (kind, help_text, value) in sorted((extra or {}).items()):
+        family(name, kind, help_text, [(name, {}, value)])
+    return "\n".join(lines) + "\n"
+
+
+def profile_report(profile, stats_text):
+    """Plain-text dump of one request: its SQL statements, then the Python profile."""
+    total = sum(seconds for _, seconds in profile.statements)
+    lines = [f"{len(profile.statements)} SQL statements, {total * 1000:.2f} ms", ""]
+    for label, seconds in profile.statements:
+        lines.append(f"{seconds * 1000:9.3f} ms  {label}")
+    repeated = [(label, count) for label, count in profile.counts.most_common() if count > 1]
+    if repeated:
+        lines += ["", "Repeated statements:"]
+        lines += [f"{count:6d} x  {label}" for label, count in repeated]
+    return "\n".join(lines) + "\n\n" + stats_text
@@ -0,0 +1,86 @@
+"""
+Versioned, forward-only schema migrations for crimcuts.db.
+
+Every change to the schema is a file in migrations/ named NNNN_description.sql.
+The number of the last applied file is stored in the database itself
+(PRAGMA user_version), and migrate() applies every newer file in order, each
+in its own transaction, so a fresh database and an old one end up with exactly
+the same tables and indexes.
+
+Migrations may call the SQL functions from ranking.py (0009 backfills the
+leaderboard scores with them); migrate() registers those on the connection it
+is given, so a bare sqlite3 connection works too.
+
+Files are never edited once released; to change something, add a new file.
+"""
+import os
+import re
+import sqlite3
+
+import ranking
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+FILENAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Return [(version, name, sql), ...] sorted by version."""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = FILENAME.match(filename)
+        if match is None:
+            continue
+        with open(os.path.join(directory, filename), encoding="utf-8") as f:
+            migrations.append((int(match.group(1)), match.group(2), f.read()))
+    migrations.sort()
+
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError("Two migrations share the same number")
+    return migrations
+
+
+def split_statements(sql):
+    """Split a script into single statements (trigger bodies stay in one piece)."""
+    statements = []
+    buffer = ""
+    for line in sql.splitlines(keepends=True):
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ""
+    if buffer.strip() and not all(l.strip().startswith("--") or not l.strip() for l in buffer.splitlines()):
+        raise ValueError("Migration ends with an incomplete statement")
+    return statements
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, directory=MIGRATIONS_DIR):
+    """
+    Apply all pending migrations. Returns the names of the ones applied.
+
+    Each migration takes the write lock first and re-reads the version, so
+    several workers starting at once apply every file exactly once.
+    """
+    ranking.register_functions(conn)
+    applied = []
+    for version, name, sql in load_migrations(directory):
+        if version <= current_version(conn):
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= current_version(conn):
+                conn.rollback()
+                continue
+            for statement in split_statements(sql):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(f"{version:04d}_{name}")
+    return applied
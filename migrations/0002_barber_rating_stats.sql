@@ -0,0 +1,27 @@
+-- Running rating totals per barber, kept up to date by rate_barber / delete_rating.
+
+CREATE TABLE IF NOT EXISTS barber_rating_stats (
+    barber_id     INTEGER PRIMARY KEY,
+    rating_sum    INTEGER NOT NULL DEFAULT 0,
+    rating_count  INTEGER NOT NULL DEFAULT 0,
+    stars_1       INTEGER NOT NULL DEFAULT 0,
+    stars_2       INTEGER NOT NULL DEFAULT 0,
+    stars_3       INTEGER NOT NULL DEFAULT 0,
+    stars_4       INTEGER NOT NULL DEFAULT 0,
+    stars_5       INTEGER NOT NULL DEFAULT 0,
+    last_rated_at DATETIME,
+    FOREIGN KEY (barber_id) REFERENCES barbers(id)
+);
+
+DELETE FROM barber_rating_stats;
+INSERT INTO barber_rating_stats
+    (barber_id, rating_sum, rating_count,
+     stars_1, stars_2, stars_3, stars_4, stars_5, last_rated_at)
+SELECT
+    barber_id,
+    SUM(rating),
+    COUNT(*),
+    SUM(rating = 1), SUM(rating = 2), SUM(rating = 3), SUM(rating = 4), SUM(rating = 5),
+    MAX(created_at)
+FROM ratings
+GROUP BY barber_id;
@@ -0,0 +1,50 @@
+-- full-text index for /search_shops, rowid = shops.id
+CREATE VIRTUAL TABLE IF NOT EXISTS shop_search USING fts5(
+    name, location, description, barber_names,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+
+-- every distinct word in the index, used for typo-tolerant lookups
+CREATE VIRTUAL TABLE IF NOT EXISTS shop_search_terms USING fts5vocab(shop_search, row);
+
+-- keep shop_search in sync with shops and barbers
+CREATE TRIGGER IF NOT EXISTS shop_search_shop_insert AFTER INSERT ON shops BEGIN
+    INSERT INTO shop_search (rowid, name, location, description, barber_names)
+    VALUES (NEW.id, NEW.name, NEW.location, NEW.description, '');
+END;
+
+CREATE TRIGGER IF NOT EXISTS shop_search_shop_update AFTER UPDATE ON shops BEGIN
+    UPDATE shop_search
+    SET name = NEW.name, location = NEW.location, description = NEW.description
+    WHERE rowid = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS shop_search_shop_delete AFTER DELETE ON shops BEGIN
+    DELETE FROM shop_search WHERE rowid = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS shop_search_barber_insert AFTER INSERT ON barbers BEGIN
+    UPDATE shop_search
+    SET barber_names = (SELECT group_concat(name, ' ') FROM barbers WHERE shop_id = NEW.shop_id)
+    WHERE rowid = NEW.shop_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS shop_search_barber_update AFTER UPDATE ON barbers BEGIN
+    UPDATE shop_search
+    SET barber_names = (SELECT group_concat(name, ' ') FROM barbers WHERE shop_id = shop_search.rowid)
+    WHERE rowid IN (OLD.shop_id, NEW.shop_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS shop_search_barber_delete AFTER DELETE ON barbers BEGIN
+    UPDATE shop_search
+    SET barber_names = (SELECT group_concat(name, ' ') FROM barbers WHERE shop_id = OLD.shop_id)
+    WHERE rowid = OLD.shop_id;
+END;
+
+DELETE FROM shop_search;
+INSERT INTO shop_search (rowid, name, location, description, barber_names)
+SELECT
+    shops.id, shops.name, shops.location, shops.description,
+    COALESCE((SELECT group_concat(barbers.name, ' ') FROM barbers WHERE barbers.shop_id = shops.id), '')
+FROM shops;
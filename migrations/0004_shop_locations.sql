@@ -0,0 +1,29 @@
+-- R*Tree over shop coordinates for the map's nearby / viewport queries, id = shops.id
+CREATE VIRTUAL TABLE IF NOT EXISTS shop_locations USING rtree(
+    id, min_lat, max_lat, min_lon, max_lon
+);
+
+-- keep shop_locations in sync with shops, skipping shops without numeric coordinates
+CREATE TRIGGER IF NOT EXISTS shop_locations_insert AFTER INSERT ON shops
+WHEN typeof(NEW.latitude) IN ('real', 'integer') AND typeof(NEW.longitude) IN ('real', 'integer')
+BEGIN
+    INSERT INTO shop_locations (id, min_lat, max_lat, min_lon, max_lon)
+    VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+END;
+
+CREATE TRIGGER IF NOT EXISTS shop_locations_update AFTER UPDATE OF latitude, longitude ON shops BEGIN
+    DELETE FROM shop_locations WHERE id = OLD.id;
+    INSERT INTO shop_locations (id, min_lat, max_lat, min_lon, max_lon)
+    SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+    WHERE typeof(NEW.latitude) IN ('real', 'integer') AND typeof(NEW.longitude) IN ('real', 'integer');
+END;
+
+CREATE TRIGGER IF NOT EXISTS shop_locations_delete AFTER DELETE ON shops BEGIN
+    DELETE FROM shop_locations WHERE id = OLD.id;
+END;
+
+DELETE FROM shop_locations;
+INSERT INTO shop_locations (id, min_lat, max_lat, min_lon, max_lon)
+SELECT id, latitude, latitude, longitude, longitude
+FROM shops
+WHERE typeof(latitude) IN ('real', 'integer') AND typeof(longitude) IN ('real', 'integer');
@@ -0,0 +1,2 @@
+-- newest-first ratings of one barber (barber_detail pagination, rating lookups)
+CREATE INDEX IF NOT EXISTS idx_ratings_barber_id ON ratings(barber_id, id);
@@ -0,0 +1,12 @@
+-- Photos uploaded through /haircut_upload. haircut_upload() has always written
+-- here, but the table was never created.
+
+CREATE TABLE IF NOT EXISTS haircut_photos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    barber_id INTEGER NOT NULL,
+    photo TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (barber_id) REFERENCES barbers(id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_haircut_photos_barber_id ON haircut_photos(barber_id, id);
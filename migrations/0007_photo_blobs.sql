@@ -0,0 +1,13 @@
+-- how many ratings / haircut_photos rows use each content-addressed photo (see photo_store.py)
+CREATE TABLE IF NOT EXISTS photo_blobs (
+    photo      TEXT PRIMARY KEY,
+    ref_count  INTEGER NOT NULL DEFAULT 0,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+DELETE FROM photo_blobs;
+INSERT INTO photo_blobs (photo, ref_count)
+SELECT photo, COUNT(*)
+FROM (SELECT photo FROM ratings UNION ALL SELECT photo FROM haircut_photos)
+WHERE photo LIKE 'static/photos/%'
+GROUP BY photo;
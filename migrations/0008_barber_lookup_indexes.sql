@@ -0,0 +1,5 @@
+-- barbers of one shop (/barbers directory, shop_search triggers, tiles)
+CREATE INDEX IF NOT EXISTS idx_barbers_shop_id ON barbers(shop_id, name);
+
+-- barber lookup by name in haircut_upload()
+CREATE INDEX IF NOT EXISTS idx_barbers_name ON barbers(name);
@@ -0,0 +1,22 @@
+-- Leaderboard scores per barber, see ranking.py.
+-- ranking_bayes() and ranking_trend_sum() are SQL functions the app registers
+-- on every connection (ranking.register_functions).
+
+ALTER TABLE barber_rating_stats ADD COLUMN shop_id INTEGER;
+ALTER TABLE barber_rating_stats ADD COLUMN bayes_score REAL;
+ALTER TABLE barber_rating_stats ADD COLUMN trend_log REAL;
+
+UPDATE barber_rating_stats SET
+    shop_id = (SELECT shop_id FROM barbers WHERE barbers.id = barber_rating_stats.barber_id),
+    bayes_score = ranking_bayes(rating_sum, rating_count),
+    trend_log = (
+        SELECT ranking_trend_sum(rating, created_at)
+        FROM ratings
+        WHERE ratings.barber_id = barber_rating_stats.barber_id
+    );
+
+-- top-N globally and per shop, read in descending order
+CREATE INDEX IF NOT EXISTS idx_rating_stats_bayes ON barber_rating_stats(bayes_score);
+CREATE INDEX IF NOT EXISTS idx_rating_stats_shop_bayes ON barber_rating_stats(shop_id, bayes_score);
+CREATE INDEX IF NOT EXISTS idx_rating_stats_trend ON barber_rating_stats(trend_log);
+CREATE INDEX IF NOT EXISTS idx_rating_stats_shop_trend ON barber_rating_stats(shop_id, trend_log);
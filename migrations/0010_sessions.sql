@@ -0,0 +1,9 @@
+-- Server-side session data, see sessions.py. 'id' is the SHA-256 of the cookie value.
+
+CREATE TABLE IF NOT EXISTS sessions (
+    id         TEXT PRIMARY KEY,
+    data       TEXT NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions(expires_at);
@@ -0,0 +1,18 @@
+-- background jobs (see jobs.py); a job's row is deleted when it succeeds
+CREATE TABLE IF NOT EXISTS jobs (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind         TEXT NOT NULL,
+    payload      TEXT NOT NULL DEFAULT '{}',
+    -- queued, running or failed (gave up after max_attempts)
+    status       TEXT NOT NULL DEFAULT 'queued',
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    -- unix times
+    run_after    REAL NOT NULL,
+    locked_until REAL,
+    last_error   TEXT,
+    created_at   REAL NOT NULL
+);
+
+-- the next job to run: WHERE status = 'queued' AND run_after <= now ORDER BY run_after
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, run_after);
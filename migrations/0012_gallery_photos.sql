@@ -0,0 +1,65 @@
+-- Every haircut photo, from ratings.photo and haircut_photos, in one table for the
+-- galleries. 'id' grows with every new photo, so it is the keyset cursor: a page is
+-- WHERE barber_id = ? AND id < ? ORDER BY id DESC LIMIT ?, read straight from an index.
+-- Kept in sync by the triggers below; shop_id is copied from barbers.
+CREATE TABLE IF NOT EXISTS gallery_photos (
+    id               INTEGER PRIMARY KEY AUTOINCREMENT,
+    photo            TEXT NOT NULL,
+    barber_id        INTEGER NOT NULL,
+    shop_id          INTEGER,
+    -- the row the photo belongs to, one of the two
+    rating_id        INTEGER UNIQUE,
+    haircut_photo_id INTEGER UNIQUE,
+    created_at       DATETIME
+);
+
+CREATE INDEX IF NOT EXISTS idx_gallery_photos_barber ON gallery_photos(barber_id, id);
+CREATE INDEX IF NOT EXISTS idx_gallery_photos_shop ON gallery_photos(shop_id, id);
+
+CREATE TRIGGER IF NOT EXISTS gallery_rating_insert AFTER INSERT ON ratings
+WHEN NEW.photo IS NOT NULL BEGIN
+    INSERT INTO gallery_photos (photo, barber_id, shop_id, rating_id, created_at)
+    VALUES (NEW.photo, NEW.barber_id, (SELECT shop_id FROM barbers WHERE id = NEW.barber_id),
+            NEW.id, NEW.created_at);
+END;
+
+-- also fired by the rating upsert's DO UPDATE; a new photo moves to the front
+CREATE TRIGGER IF NOT EXISTS gallery_rating_update AFTER UPDATE OF photo ON ratings
+WHEN OLD.photo IS NOT NEW.photo BEGIN
+    DELETE FROM gallery_photos WHERE rating_id = OLD.id;
+    INSERT INTO gallery_photos (photo, barber_id, shop_id, rating_id, created_at)
+    SELECT NEW.photo, NEW.barber_id, (SELECT shop_id FROM barbers WHERE id = NEW.barber_id),
+           NEW.id, CURRENT_TIMESTAMP
+    WHERE NEW.photo IS NOT NULL;
+END;
+
+CREATE TRIGGER IF NOT EXISTS gallery_rating_delete AFTER DELETE ON ratings
+WHEN OLD.photo IS NOT NULL BEGIN
+    DELETE FROM gallery_photos WHERE rating_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS gallery_haircut_insert AFTER INSERT ON haircut_photos
+WHEN NEW.photo IS NOT NULL BEGIN
+    INSERT INTO gallery_photos (photo, barber_id, shop_id, haircut_photo_id, created_at)
+    VALUES (NEW.photo, NEW.barber_id, (SELECT shop_id FROM barbers WHERE id = NEW.barber_id),
+            NEW.id, NEW.created_at);
+END;
+
+CREATE TRIGGER IF NOT EXISTS gallery_haircut_delete AFTER DELETE ON haircut_photos BEGIN
+    DELETE FROM gallery_photos WHERE haircut_photo_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS gallery_barber_update AFTER UPDATE OF shop_id ON barbers BEGIN
+    UPDATE gallery_photos SET shop_id = NEW.shop_id WHERE barber_id = NEW.id;
+END;
+
+-- existing photos, oldest first so ids follow upload order
+DELETE FROM gallery_photos;
+INSERT INTO gallery_photos (photo, barber_id, shop_id, rating_id, haircut_photo_id, created_at)
+SELECT photo, barber_id, (SELECT shop_id FROM barbers WHERE id = source.barber_id), rating_id, haircut_photo_id, created_at
+FROM (
+    SELECT photo, barber_id, id AS rating_id, NULL AS haircut_photo_id, created_at FROM ratings WHERE photo IS NOT NULL
+    UNION ALL
+    SELECT photo, barber_id, NULL, id, created_at FROM haircut_photos WHERE photo IS NOT NULL
+) AS source
+ORDER BY created_at, rating_id, haircut_photo_id;
@@ -0,0 +1,11 @@
+-- barber_rating_stats.shop_id is copied from barbers when a barber's first rating
+-- arrives; keep it in sync when a barber moves to another shop, as 0012 does for
+-- gallery_photos, so the per-shop leaderboard ranks them under the right shop.
+CREATE TRIGGER IF NOT EXISTS rating_stats_barber_update AFTER UPDATE OF shop_id ON barbers BEGIN
+    UPDATE barber_rating_stats SET shop_id = NEW.shop_id WHERE barber_id = NEW.id;
+END;
+
+-- barbers moved before this trigger existed
+UPDATE barber_rating_stats SET
+    shop_id = (SELECT shop_id FROM barbers WHERE barbers.id = barber_rating_stats.barber_id)
+WHERE shop_id IS NOT (SELECT shop_id FROM barbers WHERE barbers.id = barber_rating_stats.barber_id);
@@ -0,0 +1,163 @@
+"""
+Password hashing for CrimCutz.
+
+pbkdf2 is slow on purpose, so hashing a password can take the better part of a
+second of CPU. Instead of doing that on the request thread, hashes are computed
+in a small process pool:
+
+- the work does not hold the GIL of the web worker, so other threads keep serving
+- at most 'max_pending' hashes wait or run at once; past that callers wait
+  'queue_timeout' seconds and then get PasswordHasherBusy
+- the pbkdf2 iteration count is configurable, and verify_password() reports when
+  a stored hash was made with different settings so login can upgrade it
+
+This module must not import app.py: the pool's worker processes import it.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_ITERATIONS = 1000000
+SALT_LENGTH = 16
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hashes are already queued."""
+
+
+# current settings, changed with configure()
+_settings = {
+    "iterations": DEFAULT_ITERATIONS,
+    # 0 hashes inline on the calling thread (no pool)
+    "workers": os.cpu_count() or 1,
+    "max_pending": 4 * (os.cpu_count() or 1),
+    "queue_timeout": 10.0,
+}
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_slots = threading.BoundedSemaphore(_settings["max_pending"])
+
+# counters reported by stats()
+_stats = {
+    "hash_count": 0,
+    "hash_seconds_total": 0.0,
+    "hash_seconds_max": 0.0,
+    "verify_count": 0,
+    "verify_seconds_total": 0.0,
+    "verify_seconds_max": 0.0,
+    "rehash_count": 0,
+    "busy_count": 0,
+    "queue_depth": 0,
+    "queue_depth_max": 0,
+}
+
+
+def configure(iterations=None, workers=None, max_pending=None, queue_timeout=None):
+    """Change the hashing settings; call before the first request."""
+    global _slots
+    with _lock:
+        if iterations is not None:
+            _settings["iterations"] = int(iterations)
+        if workers is not None:
+            _settings["workers"] = int(workers)
+        if max_pending is not None:
+            _settings["max_pending"] = int(max_pending)
+            _slots = threading.BoundedSemaphore(_settings["max_pending"])
+        if queue_timeout is not None:
+            _settings["queue_timeout"] = float(queue_timeout)
+    _shutdown_executor()
+
+
+def _method():
+    return f"pbkdf2:sha256:{_settings['iterations']}"
+
+
+def _get_executor():
+    """Return this process's pool, creating it on first use (and again after a fork)."""
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(max_workers=_settings["workers"])
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _shutdown_executor():
+    global _executor
+    with _lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=False)
+        _executor = None
+
+
+def _record(kind, seconds):
+    with _lock:
+        _stats[kind + "_count"] += 1
+        _stats[kind + "_seconds_total"] += seconds
+        _stats[kind + "_seconds_max"] = max(_stats[kind + "_seconds_max"], seconds)
+
+
+def _run(kind, func, *args):
+    """Run func(*args) in the pool, waiting for a free slot first."""
+    if not _slots.acquire(timeout=_settings["queue_timeout"]):
+        with _lock:
+            _stats["busy_count"] += 1
+        raise PasswordHasherBusy()
+
+    with _lock:
+        _stats["queue_depth"] += 1
+        _stats["queue_depth_max"] = max(_stats["queue_depth_max"], _stats["queue_depth"])
+    start = time.perf_counter()
+    try:
+        if _settings["workers"] == 0:
+            return func(*args)
+        return _get_executor().submit(func, *args).result()
+    finally:
+        # latency includes time spent waiting for a pool process
+        _record(kind, time.perf_counter() - start)
+        with _lock:
+            _stats["queue_depth"] -= 1
+        _slots.release()
+
+
+def hash_password(password):
+    """Hash a password with the configured settings."""
+    return _run("hash", generate_password_hash, password, _method(), SALT_LENGTH)
+
+
+def needs_rehash(pwhash):
+    """True if 'pwhash' was not made with the current method, iterations and salt length."""
+    method, _, rest = pwhash.partition("$")
+    salt = rest.partition("$")[0]
+    return method != _method() or len(salt) != SALT_LENGTH
+
+
+def verify_password(pwhash, password):
+    """
+    Check a password against a stored hash.
+
+    Returns (ok, needs_rehash); the second value is only True for a correct
+    password whose hash should be replaced with hash_password().
+    """
+    ok = _run("verify", check_password_hash, pwhash, password)
+    return ok, ok and needs_rehash(pwhash)
+
+
+def record_rehash():
+    with _lock:
+        _stats["rehash_count"] += 1
+
+
+def stats():
+    """Snapshot of the hashing counters plus the current settings."""
+    with _lock:
+        snapshot = dict(_stats)
+        snapshot["iterations"] = _settings["iterations"]
+        snapshot["workers"] = _settings["workers"]
+        snapshot["max_pending"] = _settings["max_pending"]
+    return snapshot
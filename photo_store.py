@@ -0,0 +1,337 @@
+"""
+Content-addressed storage for haircut photos.
+
+A photo is stored under the SHA-256 of the uploaded file, in sharded directories:
+
+    static/photos/3f/a2/3fa2...e9_full.webp   (plus _card and _thumb, see images.py)
+
+so uploading the same picture twice stores it once, and a file never changes
+after it is written (its URL can be cached forever).
+
+The photo_blobs table counts how many rows of ratings.photo and
+haircut_photos.photo point at each stored photo. Callers change the count in
+the same transaction as the row that references the photo:
+
+    path = store_photo(db, stream)   # +1, writes the files if they are new
+    release_photo(db, old_path)      # -1
+    db.commit()
+    collect_garbage(db)              # deletes files nobody references any more
+
+Photos uploaded before this store (static/barber_images/...) are moved into it
+with store_file() by 'flask --app app photos-migrate-legacy'.
+
+Resizing can be left to a background job: store_photo(db, stream, defer=True)
+only checks the upload and keeps it as <digest>_upload next to where the
+variants will go, and process_photo(path) writes them later. Until then
+is_ready(path) is False.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import images
+
+STORE_DIR = os.path.join("static", "photos")
+CHUNK_SIZE = 64 * 1024
+# enough leading bytes to recognise every format we accept
+HEADER_BYTES = 12
+# uploads still being received are younger than this
+RECEIVING_MAX_AGE = 3600
+
+
+def looks_like_image(header):
+    """True if the first bytes of a file are a JPEG, PNG, GIF or WebP signature."""
+    return (
+        header.startswith(b"\xff\xd8\xff")
+        or header.startswith(b"\x89PNG\r\n\x1a\n")
+        or header.startswith((b"GIF87a", b"GIF89a"))
+        or (header.startswith(b"RIFF") and header[8:12] == b"WEBP")
+    )
+
+
+class StreamedUpload:
+    """
+    File object the form parser writes an uploaded photo into, chunk by chunk.
+
+    Werkzeug normally buffers uploads in a SpooledTemporaryFile and the view
+    copies them again. Here every chunk goes straight to a temporary file in
+    STORE_DIR while we:
+    - stop with 413 as soon as the upload passes 'max_bytes'
+    - check the first bytes for an image signature, and throw the rest of
+      the upload away without writing it if they are wrong
+    - compute the SHA-256 on the way, so store_photo() does not re-read the file
+    Being on the same file system as the store, the file is hard-linked to its
+    final path by store_photo(defer=True) instead of copied (see link_to()).
+    The temporary name is deleted when the request closes it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.header = b""
+        self.rejected = False
+        self.digest = hashlib.sha256()
+        os.makedirs(STORE_DIR, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=STORE_DIR, prefix=".receiving-")
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+        if len(self.header) < HEADER_BYTES:
+            self.header += data[:HEADER_BYTES - len(self.header)]
+            if len(self.header) == HEADER_BYTES and not looks_like_image(self.header):
+                self.rejected = True
+        if self.rejected:
+            return len(data)
+        self.digest.update(data)
+        return self.file.write(data)
+
+    @property
+    def is_image(self):
+        return not self.rejected and looks_like_image(self.header)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def link_to(self, path):
+        """Give the received file a second name, 'path' (kept as it is if it already exists)."""
+        self.file.flush()
+        try:
+            os.link(self.file.name, path)
+        except FileExistsError:
+            # same digest, same content
+            pass
+
+    def __getattr__(self, name):
+        # read, seek, tell, close, ... come from the temporary file
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+
+def content_hash(stream):
+    """SHA-256 of a file-like object, read in chunks; rewinds it afterwards."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def blob_dir(digest):
+    return os.path.join(STORE_DIR, digest[:2], digest[2:4])
+
+
+def blob_path(digest):
+    """Database value for a stored photo: the path of its _full variant."""
+    return os.path.join(blob_dir(digest), f"{digest}_full.webp").replace(os.sep, "/")
+
+
+def upload_path(digest):
+    """Where an upload waits for process_photo()."""
+    return os.path.join(blob_dir(digest), f"{digest}_upload")
+
+
+def photo_digest(photo):
+    return os.path.basename(photo)[: -len("_full.webp")]
+
+
+def is_stored_photo(photo):
+    """True if 'photo' is a path managed by this store (not a legacy upload)."""
+    return bool(photo) and photo.replace(os.sep, "/").startswith(STORE_DIR.replace(os.sep, "/") + "/")
+
+
+def _write_variants(stream, digest):
+    """Write all variants into a temp dir and move them into place."""
+    directory = blob_dir(digest)
+    os.makedirs(directory, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=directory)
+    try:
+        images.save_image_variants(stream, tmp, digest)
+        for name in os.listdir(tmp):
+            # rename is atomic, readers never see a half-written file
+            os.replace(os.path.join(tmp, name), os.path.join(directory, name))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _save_upload(stream, digest):
+    """Keep the upload as it is, for process_photo()."""
+    directory = blob_dir(digest)
+    os.makedirs(directory, exist_ok=True)
+    if isinstance(stream, StreamedUpload):
+        # already on disk next to the store: no second copy
+        stream.link_to(upload_path(digest))
+        return
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(stream, f, CHUNK_SIZE)
+        os.replace(tmp, upload_path(digest))
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def is_ready(photo):
+    """False while a photo stored with defer=True still waits for process_photo()."""
+    return not is_stored_photo(photo) or os.path.exists(photo)
+
+
+def store_photo(db, stream, defer=False):
+    """
+    Store an uploaded photo and add one reference to it.
+
+    Returns the path to save in ratings.photo / haircut_photos.photo.
+    Raises images.InvalidImage if the upload is not an image.
+    With defer=True the image is only checked and saved; call process_photo() later.
+    The caller must commit.
+    """
+    if isinstance(stream, StreamedUpload):
+        # hashed and checked while it was being received
+        if not stream.is_image:
+            raise images.InvalidImage("not an image")
+        stream.seek(0)
+        digest = stream.hexdigest()
+    else:
+        digest = content_hash(stream)
+    path = blob_path(digest)
+
+    if defer:
+        images.check_image(stream)
+        write = _save_upload
+        stored = lambda: os.path.exists(path) or os.path.exists(upload_path(digest))
+    else:
+        write = _write_variants
+        stored = lambda: os.path.exists(path)
+
+    # decode and resize before taking the write lock, unless we already have it
+    if not stored():
+        write(stream, digest)
+        stream.seek(0)
+
+    db.execute("""
+        INSERT INTO photo_blobs (photo, ref_count) VALUES (?, 1)
+        ON CONFLICT(photo) DO UPDATE SET ref_count = ref_count + 1
+    """, (path,))
+
+    # collect_garbage() may have removed the files between the check and the insert;
+    # now that we hold the write lock it cannot happen again
+    if not stored():
+        write(stream, digest)
+    return path
+
+
+def store_file(path):
+    """
+    Write the variants of an image file saved before this store existed, unless
+    the same picture is already stored. Returns the path to save in its rows;
+    the database is not touched. Raises images.InvalidImage if it is not an image.
+    """
+    with open(path, "rb") as f:
+        digest = content_hash(f)
+        if not os.path.exists(blob_path(digest)):
+            _write_variants(f, digest)
+    return blob_path(digest)
+
+
+def process_photo(photo):
+    """
+    Write the variants of a photo stored with defer=True and delete the upload.
+    Returns False if there was nothing to do (already done, or the photo was deleted).
+    Raises images.InvalidImage if the upload cannot be decoded.
+    """
+    digest = photo_digest(photo)
+    upload = upload_path(digest)
+    if os.path.exists(photo) or not os.path.exists(upload):
+        return False
+    with open(upload, "rb") as f:
+        _write_variants(f, digest)
+    os.remove(upload)
+    return True
+
+
+def release_photo(db, photo):
+    """
+    Drop one reference to a stored photo. The caller must commit.
+    Returns True if the photo may now be garbage.
+    """
+    if not is_stored_photo(photo):
+        return False
+    db.execute("UPDATE photo_blobs SET ref_count = ref_count - 1 WHERE photo = ?", (photo,))
+    return True
+
+
+def _delete_files(photo):
+    paths = list(images.photo_variants(photo).values())
+    if is_stored_photo(photo):
+        paths.append(upload_path(photo_digest(photo)))
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def collect_garbage(db):
+    """
+    Delete stored photos that nothing references any more.
+
+    Runs in its own write transaction, so a concurrent store_photo() of the
+    same picture either sees the row gone and rewrites the files, or keeps it alive.
+    Returns the number of photos removed.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute("SELECT photo FROM photo_blobs WHERE ref_count <= 0").fetchall()
+        for row in rows:
+            db.execute("DELETE FROM photo_blobs WHERE photo = ?", (row[0],))
+            _delete_files(row[0])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(rows)
+
+
+def rebuild_refs(db):
+    """Recount photo_blobs from ratings and haircut_photos. The caller must commit."""
+    db.execute("UPDATE photo_blobs SET ref_count = 0")
+    db.execute("""
+        INSERT INTO photo_blobs (photo, ref_count)
+        SELECT photo, COUNT(*) FROM (SELECT photo FROM ratings UNION ALL SELECT photo FROM haircut_photos)
+        WHERE photo LIKE ?
+        GROUP BY photo
+        ON CONFLICT(photo) DO UPDATE SET ref_count = excluded.ref_count
+    """, (STORE_DIR.replace(os.sep, "/") + "/%",))
+
+
+def remove_orphan_files(db):
+    """
+    Delete files in the store that have no photo_blobs row. Returns how many.
+    Meant for maintenance: an upload in progress has files but no row yet.
+    """
+    known = {row[0] for row in db.execute("SELECT photo FROM photo_blobs")}
+    removed = 0
+    for directory, _, files in os.walk(STORE_DIR):
+        for name in files:
+            path = os.path.join(directory, name)
+            if name.startswith(".receiving-"):
+                # left behind by a worker that died while receiving an upload
+                if time.time() - os.path.getmtime(path) > RECEIVING_MAX_AGE:
+                    os.remove(path)
+                    removed += 1
+                continue
+            if not name.endswith((".webp", "_upload")):
+                continue
+            digest = name.rsplit("_", 1)[0]
+            if blob_path(digest) not in known:
+                os.remove(path)
+                removed += 1
+    return removed
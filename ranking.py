@@ -0,0 +1,109 @@
+"""
+Barber rankings for the leaderboard.
+
+Two scores are stored per barber in barber_rating_stats and updated together
+with the rating totals, so the leaderboard is an indexed ORDER BY ... LIMIT:
+
+bayes_score
+    Average rating pulled towards PRIOR_MEAN as if every barber started with
+    PRIOR_WEIGHT ratings of that value, so one lucky 5-star review does not
+    beat fifty 4.8 averages:  (PRIOR_WEIGHT * PRIOR_MEAN + sum) / (PRIOR_WEIGHT + count)
+
+trend_log
+    Stars received recently, where a rating loses half its weight every
+    HALF_LIFE_DAYS. Decaying every barber's score as time passes would mean
+    rewriting every row, so instead each rating is stored "forward decayed":
+    it counts stars * exp(DECAY * (rated_at - EPOCH)), which grows with time,
+    and newer ratings automatically outweigh older ones. The column holds the
+    log of the sum (the raw sum overflows after a few years); ordering by it is
+    the same as ordering by the decayed score, and trend_value() turns it back
+    into "recent stars" at a given moment.
+
+register_functions() makes these available in SQL (as ranking_bayes,
+ranking_trend_term, ranking_trend_update and ranking_trend_sum) on every connection.
+"""
+import math
+from datetime import datetime, timezone
+
+PRIOR_MEAN = 3.5
+PRIOR_WEIGHT = 5
+HALF_LIFE_DAYS = 7
+DECAY = math.log(2) / (HALF_LIFE_DAYS * 86400)
+EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp()
+SQLITE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def bayes_score(rating_sum, rating_count):
+    """Smoothed average, or None for a barber without ratings."""
+    if not rating_count:
+        return None
+    return (PRIOR_WEIGHT * PRIOR_MEAN + rating_sum) / (PRIOR_WEIGHT + rating_count)
+
+
+def now_timestamp():
+    """Current UTC time in the format of SQLite's CURRENT_TIMESTAMP."""
+    return datetime.now(timezone.utc).strftime(SQLITE_TIME_FORMAT)
+
+
+def _seconds(timestamp):
+    if timestamp is None:
+        return EPOCH
+    parsed = datetime.strptime(timestamp[:19], SQLITE_TIME_FORMAT)
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+def trend_term(rating, rated_at):
+    """Log of one rating's forward-decayed weight."""
+    return math.log(rating) + DECAY * (_seconds(rated_at) - EPOCH)
+
+
+def trend_update(trend_log, removed_term=None, added_term=None):
+    """
+    Remove and/or add one term to a stored trend_log (log of a sum).
+    Returns None once nothing is left, which includes removing a term that is
+    the whole sum to float precision: ratings much older than it still count,
+    so a caller with ratings left recomputes from them (see update_rating_stats).
+    """
+    if removed_term is not None and trend_log is not None:
+        if removed_term >= trend_log - 1e-9:
+            trend_log = None
+        else:
+            # log(e^L - e^x) without leaving log space
+            trend_log = trend_log + math.log1p(-math.exp(removed_term - trend_log))
+    if added_term is not None:
+        if trend_log is None:
+            trend_log = added_term
+        else:
+            high, low = max(trend_log, added_term), min(trend_log, added_term)
+            trend_log = high + math.log1p(math.exp(low - high))
+    return trend_log
+
+
+def trend_value(trend_log, at=None):
+    """Recent stars as of 'at' (a unix timestamp, default now)."""
+    if trend_log is None:
+        return 0.0
+    if at is None:
+        at = datetime.now(timezone.utc).timestamp()
+    return math.exp(trend_log - DECAY * (at - EPOCH))
+
+
+class TrendSum:
+    """SQL aggregate: ranking_trend_sum(rating, created_at) -> trend_log of those ratings."""
+
+    def __init__(self):
+        self.trend_log = None
+
+    def step(self, rating, rated_at):
+        self.trend_log = trend_update(self.trend_log, added_term=trend_term(rating, rated_at))
+
+    def finalize(self):
+        return self.trend_log
+
+
+def register_functions(conn):
+    """Make the ranking math callable from SQL on this connection."""
+    conn.create_function("ranking_bayes", 2, bayes_score, deterministic=True)
+    conn.create_function("ranking_trend_term", 2, trend_term, deterministic=True)
+    conn.create_function("ranking_trend_update", 3, trend_update, deterministic=True)
+    conn.create_aggregate("ranking_trend_sum", 2, TrendSum)
@@ -0,0 +1,210 @@
+"""
+Server-side sessions for CrimCutz.
+
+Flask's default session is a signed cookie holding the data itself. Here the
+cookie only holds a random session id, and the data lives on the server in a
+pluggable store:
+
+    SQLiteSessionStore   the 'sessions' table, with an in-memory LRU in front,
+                         so most requests never touch the database for the session
+    MemorySessionStore   a plain dict, for a single process (development, tests)
+
+The table is keyed by the SHA-256 of the id, so a copy of the database does
+not contain usable cookies. Sessions expire after PERMANENT_SESSION_LIFETIME.
+
+Each worker process has its own LRU, so a session deleted (logout) in one
+worker may still be served from another worker's LRU for up to 'cache_ttl'
+seconds.
+"""
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# same serializer as Flask's cookie sessions: keeps tuples, bytes, Markup, datetimes
+serializer = TaggedJSONSerializer()
+
+
+def session_key(sid):
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data plus the id it is stored under (None until first saved)."""
+
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.rotated_from = None
+
+    def rotate(self):
+        """Move the data to a new id, e.g. at login, so an id known before login is useless."""
+        if self.sid is not None:
+            self.rotated_from = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class MemorySessionStore:
+    """Sessions in a dict, for one process."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] < time.time():
+                del self._data[key]
+                entry = None
+        return None if entry is None else serializer.loads(entry[0])
+
+    def save(self, key, data, expires_at):
+        with self._lock:
+            self._data[key] = (serializer.dumps(data), expires_at)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SQLiteSessionStore:
+    """
+    Sessions in the 'sessions' table behind an LRU of recently used ones.
+
+    'connect' opens a new database connection; each thread keeps its own, apart
+    from the request's connection, so saving a session never commits a view's work.
+    """
+
+    # delete expired rows after this many saves
+    PURGE_EVERY = 1000
+
+    def __init__(self, connect, cache_size=10000, cache_ttl=30):
+        self.connect = connect
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        # key -> (serialized data, expires_at, cached_until), least recently used first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._saves = 0
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+        return conn
+
+    def _remember(self, key, payload, expires_at):
+        with self._lock:
+            self._cache[key] = (payload, expires_at, time.monotonic() + self.cache_ttl)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def load(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and (entry[1] < now or entry[2] < time.monotonic()):
+                del self._cache[key]
+                entry = None
+            if entry is not None:
+                self._cache.move_to_end(key)
+        if entry is None:
+            row = self._db().execute(
+                "SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            entry = (row[0], row[1])
+            self._remember(key, *entry)
+        # deserialized per request, so changes to nested values never leak into the cache
+        return serializer.loads(entry[0])
+
+    def save(self, key, data, expires_at):
+        payload = serializer.dumps(data)
+        db = self._db()
+        db.execute("""
+            INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+        """, (key, payload, expires_at))
+        with self._lock:
+            self._saves += 1
+            purge = self._saves % self.PURGE_EVERY == 0
+        if purge:
+            db.execute("DELETE FROM sessions WHERE expires_at < ?", (time.time(),))
+        db.commit()
+        self._remember(key, payload, expires_at)
+
+    def delete(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+        db = self._db()
+        db.execute("DELETE FROM sessions WHERE id = ?", (key,))
+        db.commit()
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface storing session data in 'store'."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.load(session_key(sid))
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+        if not session.modified:
+            return
+
+        if session.rotated_from is not None:
+            self.store.delete(session_key(session.rotated_from))
+            session.rotated_from = None
+        if not session:
+            # emptied (logout): forget it on both sides
+            if session.sid is not None:
+                self.store.delete(session_key(session.sid))
+            response.delete_cookie(name, domain=domain, path=path,
+                                   secure=self.get_cookie_secure(app),
+                                   httponly=self.get_cookie_httponly(app),
+                                   samesite=self.get_cookie_samesite(app))
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        expires_at = time.time() + app.permanent_session_lifetime.total_seconds()
+        self.store.save(session_key(session.sid), dict(session), expires_at)
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
@@ -0,0 +1,166 @@
+"""
+Read snapshots of the CrimCutz database.
+
+In snapshot mode read-only pages are served from a copy of crimcuts.db instead
+of the database itself, so reads never share the file, its page cache or its
+WAL with the writer:
+
+    SnapshotRefresher   copies the database with SQLite's backup API into
+                        '<snapshot>.tmp' and renames it over the snapshot.
+                        Every process may run one; a lock file makes sure only
+                        one copies at a time, and nothing is copied when no
+                        commit happened since the last copy.
+    SnapshotReader      per-thread read-only connections to the snapshot
+                        (opened 'immutable', so SQLite takes no locks at all),
+                        reopened when a new copy replaces the file.
+
+A snapshot's modification time is when its copy started, i.e. it holds every
+commit made before then. The reader refuses snapshots older than 'max_age'
+seconds, so the caller falls back to the primary database instead of serving
+data staler than that.
+
+A copy reads the whole database, so its cost grows with the file; pick
+max_age so that a copy takes well under max_age / 2.
+
+This module does not know about Flask; app.py decides which routes read snapshots.
+"""
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+log = logging.getLogger("crimcuts.snapshots")
+
+
+def snapshot_uri(path):
+    """URI opening a snapshot read-only, without locking (it never changes once written)."""
+    return f"file:{quote(os.path.abspath(path))}?mode=ro&immutable=1"
+
+
+class SnapshotRefresher:
+    """Keeps the snapshot at 'path' a copy of 'database' at most max_age seconds old."""
+
+    def __init__(self, database, path, max_age):
+        self.database = database
+        self.path = path
+        self.max_age = max_age
+        # refresh half way, so a copy finishes before readers give up on the old one
+        self.interval = max(0.5, max_age / 2)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        # (connection, PRAGMA data_version) at the last copy; the number only means
+        # something to the connection that returned it
+        self._copied_version = None
+        self._stats = {"copies": 0, "copy_seconds_total": 0.0, "unchanged": 0}
+
+    def refresh(self):
+        """
+        Bring the snapshot up to date now. Returns "copied", "unchanged", or
+        "busy" if another process is refreshing it.
+        """
+        with open(self.path + ".lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return "busy"
+
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.database, check_same_thread=False)
+                self._conn.execute("PRAGMA busy_timeout = 5000")
+                self._copied_version = None
+            started = time.time()
+            # changes whenever another connection commits, in any process
+            data_version = (self._conn, self._conn.execute("PRAGMA data_version").fetchone()[0])
+            if data_version == self._copied_version and os.path.exists(self.path):
+                # nothing was committed since our last copy: it is still current
+                os.utime(self.path, (started, started))
+                with self._lock:
+                    self._stats["unchanged"] += 1
+                return "unchanged"
+
+            tmp = self.path + ".tmp"
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            copy = sqlite3.connect(tmp)
+            try:
+                # one step: a consistent read of the whole database; in WAL mode writers carry on
+                self._conn.backup(copy)
+                # readers open it immutable, which needs a rollback-journal database
+                copy.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                copy.close()
+            os.utime(tmp, (started, started))
+            # readers holding the old file keep reading it until they reopen
+            os.replace(tmp, self.path)
+            self._copied_version = data_version
+            with self._lock:
+                self._stats["copies"] += 1
+                self._stats["copy_seconds_total"] += time.time() - started
+            return "copied"
+
+    def start(self):
+        """Refresh in a background thread, once per process (again after a fork)."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # a connection inherited through fork must not be used, nor its data_version
+            self._conn = None
+            self._copied_version = None
+        threading.Thread(target=self.run, name="snapshot-refresher", daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                if self.age() >= self.interval:
+                    self.refresh()
+            except Exception:
+                log.exception("Could not refresh the snapshot %s", self.path)
+            time.sleep(self.interval / 4)
+
+    def age(self):
+        """Seconds since the current snapshot was taken (infinite if there is none)."""
+        try:
+            return time.time() - os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return float("inf")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class SnapshotReader:
+    """Per-thread connections to the snapshot at 'path', opened with connect(uri)."""
+
+    def __init__(self, path, max_age, connect):
+        self.path = path
+        self.max_age = max_age
+        self.connect = connect
+        self._local = threading.local()
+
+    def connection(self):
+        """
+        Return (connection, taken_at) for the current snapshot, or None if there
+        is none or it is older than max_age.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        if time.time() - st.st_mtime > self.max_age:
+            return None
+
+        local = self._local
+        # a new copy is a new file; the old one stays readable while we have it open
+        file_id = (st.st_dev, st.st_ino)
+        if getattr(local, "file_id", None) != file_id:
+            if getattr(local, "conn", None) is not None:
+                local.conn.close()
+            local.conn = self.connect(snapshot_uri(self.path))
+            local.file_id = file_id
+        return local.conn, st.st_mtime
@@ -0,0 +1,120 @@
+// Autocomplete client for the map search box.
+//
+// createShopSearch() returns search(query), which resolves with the shops to
+// suggest, or null when a newer call has replaced it. Compared to fetching on
+// every keystroke:
+// - calls are debounced, so typing "Harvard" sends one request, not seven
+// - a request that a newer query makes useless is aborted, so an old answer
+//   can never overwrite a newer one
+// - answers are cached per query, and when a query only narrows one whose
+//   answer was complete ("harv" -> "harvard sq"), the cached shops are filtered
+//   here using their indexed words ("terms") instead of asking the server again
+// The server's Cache-Control/ETag headers let the browser reuse the rest.
+function createShopSearch({ url = "/search_shops", limit = 10, delay = 150, cacheSize = 50 } = {}) {
+    // normalized query -> {words, shops, complete}, least recently used first
+    const cache = new Map();
+    let timer = null;
+    let controller = null;
+    let pendingResolve = null;
+
+    function queryWords(query) {
+        return query.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || [];
+    }
+
+    function remember(key, entry) {
+        cache.delete(key);
+        cache.set(key, entry);
+        if (cache.size > cacheSize) {
+            cache.delete(cache.keys().next().value);
+        }
+    }
+
+    // a shop matches when every query word starts one of its indexed words, like the server's prefix search
+    function matches(shop, words) {
+        const terms = shop.terms.split(" ");
+        return words.every(word => terms.some(term => term.startsWith(word)));
+    }
+
+    // every word of the cached query is a prefix of the word at the same place in the new one
+    function narrows(cachedWords, words) {
+        return cachedWords.length <= words.length
+            && cachedWords.every((word, i) => words[i].startsWith(word));
+    }
+
+    function fromCache(key, words) {
+        const exact = cache.get(key);
+        if (exact) {
+            remember(key, exact);
+            return exact.shops;
+        }
+        for (const entry of cache.values()) {
+            if (entry.complete && narrows(entry.words, words)) {
+                const shops = entry.shops.filter(shop => matches(shop, words));
+                // nothing left may still mean a typo the server can correct
+                if (shops.length) {
+                    remember(key, { words, shops, complete: true });
+                    return shops;
+                }
+            }
+        }
+        return null;
+    }
+
+    async function fetchShops(key, words, signal) {
+        const response = await fetch(`${url}?query=${encodeURIComponent(key)}&limit=${limit}`, { signal });
+        if (!response.ok) {
+            throw new Error(`search failed with status ${response.status}`);
+        }
+        const shops = await response.json();
+        // fewer than 'limit' hits means this is every shop matching the query
+        remember(key, { words, shops, complete: shops.length < limit });
+        return shops;
+    }
+
+    return function search(query) {
+        // the previous call is superseded: settle it and stop its request
+        clearTimeout(timer);
+        if (controller) {
+            controller.abort();
+            controller = null;
+        }
+        if (pendingResolve) {
+            pendingResolve(null);
+            pendingResolve = null;
+        }
+
+        const words = queryWords(query);
+        if (!words.length) {
+            return Promise.resolve([]);
+        }
+        const key = words.join(" ");
+        const cached = fromCache(key, words);
+        if (cached) {
+            return Promise.resolve(cached);
+        }
+
+        return new Promise((resolve, reject) => {
+            pendingResolve = resolve;
+            timer = setTimeout(() => {
+                const current = controller = new AbortController();
+                fetchShops(key, words, current.signal).then(
+                    shops => {
+                        if (controller === current) {
+                            controller = pendingResolve = null;
+                        }
+                        resolve(shops);
+                    },
+                    error => {
+                        if (error.name === "AbortError") {
+                            return resolve(null);
+                        }
+                        if (controller === current) {
+                            controller = pendingResolve = null;
+                        }
+                        reject(error);
+                    }
+                );
+            }, delay);
+        });
+    };
+}
@@ -0,0 +1,73 @@
+"""
+Fingerprinted static files for CrimCutz.
+
+At startup every file under static/ is hashed once. url_for('static', ...) then
+adds that hash to the URL (?v=<hash>), so a URL always names one exact version
+of a file and browsers may keep it for a year without asking again:
+
+    /static/style.css?v=3b1f0c9e2a7d   ->  Cache-Control: public, max-age=31536000, immutable
+
+Text files (CSS, JS, SVG) are also compressed once at startup with gzip, and
+with brotli when the 'brotli' package is installed, and served in whichever
+encoding the browser accepts. JPEG/PNG/WebP are already compressed and are sent as is.
+
+Requests without the current hash still work, but must revalidate with the ETag.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HASH_LENGTH = 12
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE = (".css", ".js", ".svg", ".json", ".txt", ".html")
+# skipped at startup: content-addressed photos already carry their hash in the name
+SKIP_DIRS = ("photos",)
+
+
+class Asset:
+    """One static file: its fingerprint and precompressed bodies."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        self.fingerprint = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        # encoding -> compressed bytes, only kept when it is actually smaller
+        self.encoded = {}
+        if path.endswith(COMPRESSIBLE):
+            candidates = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                candidates["br"] = brotli.compress(data, quality=11)
+            for encoding, body in candidates.items():
+                if len(body) < len(data):
+                    self.encoded[encoding] = body
+
+
+def build_manifest(static_folder):
+    """Return {filename: Asset} for every file under static_folder."""
+    manifest = {}
+    for directory, dirs, files in os.walk(static_folder):
+        if directory == static_folder:
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        for name in files:
+            if name.startswith("."):
+                continue
+            path = os.path.join(directory, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, "/")
+            manifest[filename] = Asset(path)
+    return manifest
+
+
+def pick_encoding(asset, accept_encodings):
+    """Best precompressed encoding the client accepts, or None."""
+    for encoding in ("br", "gzip"):
+        if encoding in asset.encoded and accept_encodings[encoding]:
+            return encoding
+    return None
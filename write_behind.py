@@ -0,0 +1,159 @@
+"""
+Write-behind queue: changes are applied by one background writer thread.
+
+SQLite has a single writer. When every request thread writes and commits on
+its own, a burst of writes means threads queueing on the write lock (and one
+fsync per commit) while they hold a worker that could be serving pages. With a
+WriteBehindQueue the request only validates and submit()s the change; the
+writer takes everything that is waiting, applies it in one transaction and
+commits once:
+
+    queue = WriteBehindQueue(connect, apply, after_commit=..., on_error=...)
+    queue.submit(change)        # returns at once (blocks only if max_pending are waiting)
+
+    apply(db, change)                    # writes one change; the queue commits
+    after_commit(db, changes, results)   # what apply() returned for each, e.g. to invalidate caches
+    on_error(db, change, error)          # a change that could not be applied on its own
+
+If a batch fails it is rolled back and its changes are retried one by one, so
+one bad change does not take the others with it.
+
+Each process has its own queue and writer (started on the first submit, and
+again after a fork). Changes submitted to one process are applied in order;
+changes sent to different gunicorn workers are not ordered among themselves.
+
+This module does not know about Flask; app.py wires it to the rating routes.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+log = logging.getLogger("crimcuts.write_behind")
+
+BATCH_SIZE = 500
+MAX_PENDING = 10000
+
+
+class WriteBehindQueue:
+    def __init__(self, connect, apply, after_commit=None, on_error=None,
+                 batch_size=BATCH_SIZE, max_pending=MAX_PENDING):
+        self.connect = connect
+        self.apply = apply
+        self.after_commit = after_commit
+        self.on_error = on_error
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        # notified after every commit, see wait_for_commit()
+        self._committed = threading.Condition(self._lock)
+        self._queue = None
+        self._pid = None
+        self._stats = {
+            "submitted": 0,
+            "applied": 0,
+            "failed": 0,
+            "batches": 0,
+            "batch_size_max": 0,
+            "commit_seconds_total": 0.0,
+        }
+
+    def _get_queue(self):
+        """Return this process's queue, starting the writer on first use (and after a fork)."""
+        with self._lock:
+            if self._queue is None or self._pid != os.getpid():
+                self._queue = queue.Queue(self.max_pending)
+                self._pid = os.getpid()
+                # daemon: the interpreter may exit without waiting, flush() drains it first
+                threading.Thread(target=self._run, args=(self._queue,), name="write-behind", daemon=True).start()
+            return self._queue
+
+    def submit(self, change):
+        """Queue a change for the writer; waits while max_pending changes are already queued."""
+        self._get_queue().put(change)
+        with self._lock:
+            self._stats["submitted"] += 1
+
+    def flush(self, timeout=None):
+        """Wait until everything submitted so far in this process is applied. Returns False on timeout."""
+        with self._lock:
+            pending = self._queue if self._pid == os.getpid() else None
+        if pending is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # Queue.join() has no timeout, so poll its unfinished count
+        with pending.all_tasks_done:
+            while pending.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                pending.all_tasks_done.wait(remaining)
+        return True
+
+    def wait_for_commit(self, timeout):
+        """Sleep until this process's writer commits a batch, or 'timeout' seconds pass."""
+        with self._committed:
+            self._committed.wait(timeout)
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["pending"] = self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+        return snapshot
+
+    def _run(self, pending):
+        db = self.connect()
+        while True:
+            batch = [pending.get()]
+            # everything that queued up while we were busy goes into this batch
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(db, batch)
+            except Exception:
+                log.exception("Write-behind writer failed")
+            finally:
+                for _ in batch:
+                    pending.task_done()
+
+    def _write(self, db, batch):
+        start = time.perf_counter()
+        try:
+            results = [self.apply(db, change) for change in batch]
+            db.commit()
+            applied = batch
+        except Exception:
+            db.rollback()
+            log.warning("Batch of %d changes failed, applying them one at a time", len(batch), exc_info=True)
+            applied = []
+            results = []
+            for change in batch:
+                try:
+                    result = self.apply(db, change)
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    log.error("Dropped change %r: %s", change, e)
+                    with self._lock:
+                        self._stats["failed"] += 1
+                    if self.on_error is not None:
+                        self.on_error(db, change, e)
+                    continue
+                applied.append(change)
+                results.append(result)
+
+        # caches are invalidated before anyone waiting in wait_for_commit() reads again
+        try:
+            if applied and self.after_commit is not None:
+                self.after_commit(db, applied, results)
+        finally:
+            with self._committed:
+                self._stats["applied"] += len(applied)
+                self._stats["batches"] += 1
+                self._stats["batch_size_max"] = max(self._stats["batch_size_max"], len(batch))
+                self._stats["commit_seconds_total"] += time.perf_counter() - start
+                self._committed.notify_all()